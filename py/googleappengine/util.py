@@ -11,12 +11,18 @@
 """Utility classes and functions for Google App Engine applications.
 """
 
-from google.appengine.api import users
+from google.appengine.api import memcache, users
 from google.appengine.ext import webapp
 
 from google.appengine.ext.webapp import template
 
-import os, simplejson
+import hashlib, inspect, os, simplejson, time
+
+try:
+    import threading
+except ImportError:
+    # Threads are not available on App Engine.
+    threading = None
 
 def contains(sequence, value):
     """A recursive version of the 'in' operator.
@@ -65,6 +71,303 @@ class ExtendedHandler(webapp.RequestHandler):
         tpath = os.path.join(TEMPLATE_BASE, tpath)
         self.response.out.write(template.render(tpath, values))
 
+class Memo(object):
+    """A cache of the responses of an action, encoded as JSON, for actions
+    whose response only depends on their arguments. See memoize.
+
+    Responses are kept for ttl seconds (forever if None) and at most size of
+    them are kept, forgetting the least recently used response first. If
+    use_memcache is True, responses are also shared through memcache, and
+    clearing the memo clears it in every process within GENERATION_INTERVAL
+    seconds. Otherwise clearing it only affects the current process.
+    """
+    # The number of seconds the current generation is kept in the process
+    # before it's read from memcache again.
+    GENERATION_INTERVAL = 1.0
+
+    def __init__(self, func, ttl = None, size = 100, use_memcache = False):
+        self.func = func
+        args, varargs, varkw, defaults = inspect.getargspec(func)
+        self.defaults = {}
+        if defaults:
+            self.defaults = dict(zip(args[-len(defaults):], defaults))
+
+        # Set by copy to the class and name of the action, for the memo of
+        # each ServiceHandler class with the action.
+        self.name = None
+
+        self.ttl = ttl
+        self.size = size
+        self.use_memcache = use_memcache
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.generation = 0
+        self.generation_expires = 0.0
+
+        self.lock = threading and threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        # Entries are [previous, next, key, response, expiry time,
+        # generation] lists, linked from the most to the least recently used,
+        # with head as both the first and the last entry.
+        self.entries = {}
+        self.head = head = [None, None, None, None, None, None]
+        head[0] = head[1] = head
+
+    def _unlink(self, entry):
+        entry[0][1] = entry[1]
+        entry[1][0] = entry[0]
+
+    def _push(self, entry):
+        head = self.head
+        entry[0] = head
+        entry[1] = head[1]
+        head[1][0] = entry
+        head[1] = entry
+
+    def _store(self, key, response, expires, generation):
+        entry = self.entries.pop(key, None)
+        if entry:
+            self._unlink(entry)
+        elif len(self.entries) >= self.size:
+            oldest = self.head[0]
+            self._unlink(oldest)
+            del self.entries[oldest[2]]
+            self.evictions += 1
+
+        entry = [None, None, key, response, expires, generation]
+        self._push(entry)
+        self.entries[key] = entry
+
+    def _generation(self):
+        # Clearing the memo starts a new generation of keys, since memcache
+        # can't delete keys by prefix. Responses stored in this process are
+        # only used while their generation is current, so that clearing the
+        # memo in another process clears it here too. The generation is only
+        # read once every GENERATION_INTERVAL seconds, so that hits in this
+        # process don't have to wait for memcache, at the cost of using old
+        # responses for up to that long after a clear in another process.
+        if not self.use_memcache:
+            return 0
+        now = time.time()
+        if now >= self.generation_expires:
+            self.generation = memcache.get('memo:' + self.name) or 0
+            self.generation_expires = now + self.GENERATION_INTERVAL
+        return self.generation
+
+    def _memcache_key(self, key, generation):
+        return 'memo:%s:%d:%s' % (self.name, generation,
+                                  hashlib.md5(key).hexdigest())
+
+    def copy(self, name):
+        """Returns a new, empty memo of the same function with the same
+        settings, named name.
+        """
+        memo = Memo(self.func, self.ttl, self.size, self.use_memcache)
+        memo.name = name
+        return memo
+
+    def key(self, args):
+        """Returns the key of a dictionary of arguments, which is the same for
+        any arguments that call the action the same way.
+        """
+        values = dict(self.defaults)
+        values.update(args)
+        return simplejson.dumps(values, sort_keys = True,
+                                separators = (',', ':'))
+
+    def get(self, key):
+        """Returns the encoded response for a key, or None."""
+        now = time.time()
+        generation = self._generation()
+        if self.lock: self.lock.acquire()
+        try:
+            entry = self.entries.get(key)
+            if (entry and entry[5] == generation and
+                (entry[4] is None or entry[4] > now)):
+                self._unlink(entry)
+                self._push(entry)
+                self.hits += 1
+                return entry[3]
+        finally:
+            if self.lock: self.lock.release()
+
+        if self.use_memcache:
+            value = memcache.get(self._memcache_key(key, generation))
+            if value:
+                expires, response = value
+                if self.lock: self.lock.acquire()
+                try:
+                    self._store(key, response, expires, generation)
+                    self.hits += 1
+                finally:
+                    if self.lock: self.lock.release()
+                return response
+
+        self.misses += 1
+        return None
+
+    def set(self, key, response):
+        """Stores the encoded response for a key."""
+        expires = None
+        if self.ttl:
+            expires = time.time() + self.ttl
+
+        generation = self._generation()
+        if self.lock: self.lock.acquire()
+        try:
+            self._store(key, response, expires, generation)
+        finally:
+            if self.lock: self.lock.release()
+
+        if self.use_memcache:
+            memcache.set(self._memcache_key(key, generation),
+                         (expires, response), self.ttl or 0)
+
+    def invalidate(self, **args):
+        """Forgets the response for the given arguments."""
+        key = self.key(args)
+        if self.lock: self.lock.acquire()
+        try:
+            entry = self.entries.pop(key, None)
+            if entry:
+                self._unlink(entry)
+        finally:
+            if self.lock: self.lock.release()
+
+        if self.use_memcache:
+            memcache.delete(self._memcache_key(key, self._generation()))
+
+    def clear(self):
+        """Forgets all responses."""
+        if self.lock: self.lock.acquire()
+        try:
+            self._reset()
+        finally:
+            if self.lock: self.lock.release()
+
+        if self.use_memcache:
+            generation = memcache.incr('memo:' + self.name)
+            if generation is None:
+                generation = 1
+                memcache.set('memo:' + self.name, generation)
+            self.generation = generation
+            self.generation_expires = time.time() + self.GENERATION_INTERVAL
+
+def memoize(ttl = None, size = 100, use_memcache = False):
+    """Makes a ServiceHandler cache the responses of an action, encoded as
+    JSON, by its arguments. The action is not called again for the same
+    arguments until the response expires or is forgotten. Only successful
+    calls are cached.
+
+    Every ServiceHandler class with the action has a cache of its own, since
+    the action may behave differently in a subclass.
+
+    Usage:
+    >>> class MathService(util.ServiceHandler):
+            @util.memoize(ttl = 60)
+            def fib(self, n): ...
+    >>> MathService._memo('fib').invalidate(n = 10)
+    >>> MathService._memo('fib').hits
+    """
+    def decorator(func):
+        func.memo = Memo(func, ttl, size, use_memcache)
+        return func
+    return decorator
+
+def invalidates(*actions):
+    """Makes a ServiceHandler forget all cached responses of the given
+    memoized actions whenever this action is called successfully.
+
+    Usage:
+    >>> @util.invalidates('get_items')
+        def add_item(self, item): ...
+    """
+    def decorator(func):
+        func.invalidates = actions
+        return func
+    return decorator
+
+class Action(object):
+    """An attribute of a service that is open to HTTP requests, along with
+    the arguments it takes if it's callable.
+    """
+    def __init__(self, name, attr):
+        self.name = name
+        self.callable = callable(attr)
+
+        # The arguments listed for the action, the arguments that must be
+        # given and the arguments that may be given (None for any).
+        self.args = None
+        self.required = ()
+        self.allowed = None
+
+        # The cache of the action if it's memoized, and the names of the
+        # actions whose caches it clears.
+        self.memo = getattr(attr, 'memo', None)
+        self.invalidates = getattr(attr, 'invalidates', ())
+
+        if inspect.ismethod(attr) or inspect.isfunction(attr):
+            args, varargs, varkw, defaults = inspect.getargspec(attr)
+            if inspect.ismethod(attr):
+                args = args[1:]
+
+            self.args = [a for a in args if not a.startswith('_')]
+            self.required = args[:len(args) - len(defaults or ())]
+            if not varkw:
+                self.allowed = frozenset(self.args)
+        elif self.callable:
+            self.args = []
+
+    def validate(self, args):
+        """Raises a TypeError if the action can't be called with a dictionary
+        of arguments.
+        """
+        missing = [a for a in self.required if a not in args]
+        if missing:
+            raise TypeError('%s() is missing the arguments %s' %
+                            (self.name, ', '.join(missing)))
+
+        if self.allowed is not None:
+            unknown = [a for a in args if a not in self.allowed]
+            if unknown:
+                raise TypeError('%s() got unexpected arguments %s' %
+                                (self.name, ', '.join(unknown)))
+
+class ServiceType(type):
+    """Builds the table of actions of a ServiceHandler class and the response
+    listing them once, when the class is created.
+    """
+    def __init__(cls, name, bases, attrs):
+        super(ServiceType, cls).__init__(name, bases, attrs)
+
+        # The attributes of ServiceHandler itself are not actions.
+        if not hasattr(cls, '_hidden'):
+            cls._hidden = frozenset(dir(cls))
+
+        # dir() includes the attributes of base classes, and getattr() gets
+        # them the same way they would be found on an instance.
+        cls._actions = {}
+        for a in dir(cls):
+            if not a.startswith('_') and a not in cls._hidden:
+                action = cls._actions[a] = Action(a, getattr(cls, a))
+                if action.memo:
+                    # The memo set by memoize is shared by every class with
+                    # the method, so each class gets a copy of its own.
+                    action.memo = action.memo.copy('%s.%s.%s' % (
+                        cls.__module__, cls.__name__, a))
+
+        listing = {}
+        for a, action in cls._actions.iteritems():
+            listing[a] = action.args
+        cls._list_json = simplejson.dumps({ 'status': 'list',
+                                            'response': listing },
+                                          separators=(',', ':'))
+
 class ServiceHandler(webapp.RequestHandler):
     """Opens up all attributes that don't start with an underscore to HTTP
     requests.
@@ -80,48 +383,198 @@ class ServiceHandler(webapp.RequestHandler):
     Arguments that start with an underscore are also ignored. For the call to
     succeed, these arguments must have a default value.
 
-    Inheritance is currently not supported. To make attributes of the base class
-    available, redefine them in the child class.
+    Several calls can be made in one request by posting a JSON array of calls
+    as the body of the request to the service without an action:
+    >>> [{"action": "add", "args": {"a": 1, "b": 2}}, {"action": "version"}]
+
+    The response has the status 'batch' and a list with the status and
+    response of every call, in the same order. If the calls don't depend on
+    each other, they can be run at the same time by posting an object
+    instead:
+    >>> {"calls": [...], "concurrent": true}
+
+    Calls are only run at the same time if _max_threads is more than 1 and
+    the runtime allows threads, which App Engine does not. Otherwise they are
+    run one at a time.
+
+    Attributes of base classes are actions too, except for the attributes of
+    ServiceHandler itself. The actions of a class and their arguments are
+    found once, when the class is created, so attributes added to the class
+    later are not actions. Calls with missing or unexpected arguments fail
+    before the action is called.
     """
+    __metaclass__ = ServiceType
+
+    # The most calls in a batch, and the most threads used to run them.
+    _max_batch = 50
+    _max_threads = 1
+
     def _is_public_attr(self, action):
-        return (not action.startswith('_') and
-                action in self.__class__.__dict__)
-               
+        return action in self._actions
+
+    @classmethod
+    def _memo(cls, action):
+        """Returns the cache of a memoized action of this class, or None."""
+        info = cls._actions.get(action)
+        return info and info.memo
+
+    def _call(self, action, args):
+        """Calls an action with a dictionary of arguments, returning the
+        status and response of the call.
+        """
+        out = { 'status': 'unknown',
+                'response': None }
+
+        try:
+            info = self._actions.get(action)
+            if not info:
+                raise AttributeError('%s is not an action of this service' %
+                                     action)
+
+            attr = getattr(self, action)
+            if info.callable:
+                info.validate(args)
+                response = attr(**args)
+            else:
+                response = attr
+
+            out['status'] = 'success'
+            out['response'] = response
+        except Exception, e:
+            out['status'] = 'error'
+            out['response'] = { 'message': str(e),
+                                'type': e.__class__.__name__ }
+        else:
+            for name in info.invalidates:
+                other = self._actions.get(name)
+                if other and other.memo:
+                    other.memo.clear()
+
+        return out
+
+    def _call_json(self, action, args):
+        """Calls an action like _call does, but returns the status and
+        response encoded as JSON. The response of a memoized action is taken
+        from its cache if possible, which skips encoding it.
+        """
+        info = self._actions.get(action)
+        memo = info and info.memo
+        if memo:
+            key = memo.key(args)
+            response = memo.get(key)
+            if response is not None:
+                return '{"status":"success","response":%s}' % response
+
+        out = self._call(action, args)
+        if memo and out['status'] == 'success':
+            response = simplejson.dumps(out['response'],
+                                        separators=(',', ':'))
+            memo.set(key, response)
+            return '{"status":"success","response":%s}' % response
+
+        return simplejson.dumps(out, separators=(',', ':'))
+
+    def _batch_call(self, call):
+        """Returns the action and arguments of a call in a batch."""
+        if not isinstance(call, dict):
+            raise ValueError('A call must be an object')
+
+        call_args = call.get('args') or {}
+        if not isinstance(call_args, dict):
+            raise ValueError('The arguments of a call must be an object')
+
+        args = {}
+        for arg, value in call_args.iteritems():
+            if arg.startswith('_'): continue
+            args[str(arg)] = value
+        return str(call.get('action', '')), args
+
+    def _batch(self, body):
+        """Runs the calls of a batch, returning a list of their results
+        encoded as JSON.
+        """
+        concurrent = False
+        if isinstance(body, dict):
+            concurrent = body.get('concurrent', False)
+            body = body.get('calls')
+        if not isinstance(body, list):
+            raise ValueError('A batch must be a list of calls')
+        if len(body) > self._max_batch:
+            raise ValueError('A batch can have at most %d calls' %
+                             self._max_batch)
+
+        # A malformed call only fails itself, the same as a call that raises
+        # an exception.
+        results = [None] * len(body)
+        queue = []
+        for i, call in enumerate(body):
+            try:
+                queue.append((i, self._batch_call(call)))
+            except Exception, e:
+                out = { 'status': 'error',
+                        'response': { 'message': str(e),
+                                      'type': e.__class__.__name__ } }
+                results[i] = simplejson.dumps(out, separators=(',', ':'))
+        count = len(queue)
+
+        def work():
+            while queue:
+                try:
+                    i, (action, args) = queue.pop(0)
+                except IndexError:
+                    return
+                results[i] = self._call_json(action, args)
+
+        threads = []
+        if concurrent and threading and self._max_threads > 1:
+            for i in xrange(min(self._max_threads, count) - 1):
+                thread = threading.Thread(target = work)
+                try:
+                    thread.start()
+                except Exception:
+                    break
+                threads.append(thread)
+
+        # The current thread takes calls too, which runs all of them if no
+        # threads could be started.
+        work()
+        for thread in threads:
+            thread.join()
+
+        return results
+
     def get(self, action):
         out = { 'status': 'unknown',
                 'response': None }
 
+        body = self.request.body
         if self._is_public_attr(action):
+            args = {}
             try:
-                args = {}
                 for arg in self.request.params:
                     if arg.startswith('_'): continue
                     args[str(arg)] = simplejson.loads(self.request.params[arg])
-
-                attr = getattr(self, action)
-                out['status'] = 'success'
-                out['response'] = attr(**args) if callable(attr) else attr
+            except Exception, e:
+                out['status'] = 'error'
+                out['response'] = { 'message': str(e),
+                                    'type': e.__class__.__name__ }
+            else:
+                json = self._call_json(action, args)
+        elif not action and body and body.lstrip()[:1] in ('[', '{'):
+            try:
+                json = '{"status":"batch","response":[%s]}' % ','.join(
+                    self._batch(simplejson.loads(body)))
             except Exception, e:
                 out['status'] = 'error'
                 out['response'] = { 'message': str(e),
                                     'type': e.__class__.__name__ }
         else:
-            out['status'] = 'list'
-            out['response'] = {}
-
-            for a in self.__class__.__dict__:
-                if self._is_public_attr(a):
-                    attr = getattr(self, a)
-                    if callable(attr):
-                        code = attr.im_func.func_code # Unsafe
-                        args = filter(lambda x: not x.startswith('_'),
-                                      code.co_varnames[1:code.co_argcount])
-                    else:
-                        args = None
-
-                    out['response'][a] = args
-            
+            json = self._list_json
+
+        if out['status'] == 'error':
+            json = simplejson.dumps(out, separators=(',', ':'))
+
         self.response.headers['Content-Type'] = 'application/json'
-        self.response.out.write(simplejson.dumps(out, separators=(',', ':')))
+        self.response.out.write(json)
 
     post = get
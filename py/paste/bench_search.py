@@ -0,0 +1,188 @@
+#
+# Copyright (c) 2008 Andreas Blixt <andreas@blixt.org>
+#
+# License: MIT license <http://www.opensource.org/licenses/mit-license.php>
+# Project homepage: <http://code.google.com/p/blixt/>
+#
+
+"""Benchmark of searching code snippets.
+
+Generates growing numbers of random snippets made of identifiers whose words
+follow a Zipf distribution, like words in real code do, and indexes them in
+memory the way the datastore indexes postings: sorted by score for every term.
+Searches are then timed through search.rank, and compared with scanning every
+snippet for the smaller counts.
+
+The in-memory index only times the ranking, not reading the postings. For the
+smaller counts, the snippets are also indexed with search.index in the
+datastore stub of the SDK, and searches are timed through the real query path
+of search.rank. The stub runs in the same process, so those times still don't
+include the latency of the real datastore. Run it with the App Engine SDK on
+the Python path:
+
+    python bench_search.py [seed] [largest count]
+"""
+
+import os, random, sys, time
+
+from google.appengine.api import apiproxy_stub_map, datastore_file_stub
+
+import search
+
+COUNTS = (1000, 10000, 100000, 1000000)
+
+# The counts for which searches are also timed by scanning every snippet.
+SCAN_LIMIT = 10000
+
+# The counts for which searches are also timed against the datastore stub.
+DATASTORE_LIMIT = 1000
+
+APP_ID = 'paste'
+
+# The number of searches timed for every count.
+QUERIES = 200
+
+WORDS = ('get set add remove parse read write open close user name url '
+         'http request response buffer string list map key value node tree '
+         'index count size length file path data item entry table row '
+         'column cache load save update delete create find search sort '
+         'filter format encode decode connect send receive event handler '
+         'error result config option server client socket stream byte '
+         'char').split()
+
+# Terms for searches are drawn from these, from most to least common.
+QUERY_WORDS = WORDS[:40]
+
+# One in this many snippets has a long hex literal, like a pasted hash or
+# key, which must not be indexed as a term.
+LITERAL_RATE = 20
+
+def zipf_word(rng):
+    # The n-th most common word is about n times rarer than the most common.
+    return WORDS[min(int(rng.paretovariate(1.0)) - 1, len(WORDS) - 1)]
+
+def identifier(rng):
+    words = [zipf_word(rng) for i in xrange(rng.randint(1, 3))]
+    if rng.random() < 0.5:
+        return '_'.join(words)
+    return words[0] + ''.join([w.capitalize() for w in words[1:]])
+
+def random_snippet(rng):
+    title = ' '.join([zipf_word(rng) for i in xrange(rng.randint(1, 4))])
+    lines = []
+    for i in xrange(rng.randint(3, 30)):
+        lines.append('%s = %s(%s, %d)' % (identifier(rng), identifier(rng),
+                                          identifier(rng), rng.randint(0, 99)))
+    if rng.randint(1, LITERAL_RATE) == 1:
+        lines.append('%s = 0x%s' % (identifier(rng), ''.join(
+            [rng.choice('0123456789abcdef')
+             for i in xrange(rng.randint(64, 1000))])))
+    return title, '\n'.join(lines)
+
+def setup_stubs():
+    """Replaces the datastore with a fresh in-process stub."""
+    os.environ['APPLICATION_ID'] = APP_ID
+
+    stubs = apiproxy_stub_map.APIProxyStubMap()
+    stubs.RegisterStub('datastore_v3', datastore_file_stub.DatastoreFileStub(
+        APP_ID, None, None))
+    apiproxy_stub_map.apiproxy = stubs
+
+def build_index(snippets):
+    """Returns a dictionary of terms and their postings, best first, the same
+    as the datastore index over postings.
+    """
+
+    postings = {}
+    for snippet_id, (title, code) in enumerate(snippets):
+        for term, score in search.term_scores(title, code).iteritems():
+            postings.setdefault(term, []).append((score, snippet_id))
+
+    for term, values in postings.iteritems():
+        values.sort(reverse = True)
+        postings[term] = [(snippet_id, score) for score, snippet_id in values]
+    return postings
+
+def scan(snippets, terms):
+    """Returns the ids of the snippets that have any of the terms, by
+    tokenizing every snippet.
+    """
+
+    terms = set(terms)
+    result = []
+    for snippet_id, (title, code) in enumerate(snippets):
+        if terms.intersection(search.tokenize(title + ' ' + code)):
+            result.append(snippet_id)
+    return result
+
+def main():
+    rng = random.Random()
+    if len(sys.argv) > 1:
+        rng.seed(int(sys.argv[1]))
+    largest = COUNTS[-2]
+    if len(sys.argv) > 2:
+        largest = int(sys.argv[2])
+
+    setup_stubs()
+    stored = 0
+
+    print '%9s %12s %12s %12s %12s %10s' % ('snippets', 'index us',
+                                             'search ms', 'datastore ms',
+                                             'scan ms', 'results')
+    snippets = []
+    for count in [n for n in COUNTS if n <= largest]:
+        while len(snippets) < count:
+            snippets.append(random_snippet(rng))
+
+        start = time.time()
+        postings = build_index(snippets)
+        index_time = time.time() - start
+
+        if max([len(term) for term in postings]) > search.MAX_LENGTH:
+            print 'A term is too long to be stored!'
+            sys.exit(1)
+
+        def fetch(term, limit):
+            return postings.get(term, [])[:limit]
+
+        queries = [[rng.choice(QUERY_WORDS) for i in xrange(rng.randint(1, 3))]
+                   for i in xrange(QUERIES)]
+
+        results = 0
+        start = time.time()
+        for terms in queries:
+            results += len(search.rank(terms, fetch))
+        search_time = time.time() - start
+
+        datastore_ms = '-'
+        if count <= DATASTORE_LIMIT:
+            for snippet_id in xrange(stored, count):
+                search.index(snippet_id, *snippets[snippet_id])
+            stored = count
+
+            start = time.time()
+            for terms in queries[:QUERIES // 10]:
+                search.rank(terms)
+            datastore_ms = '%.2f' % ((time.time() - start) /
+                                     (QUERIES // 10) * 1000)
+
+        scan_ms = '-'
+        if count <= SCAN_LIMIT:
+            start = time.time()
+            for terms in queries[:QUERIES // 10]:
+                scan(snippets, terms)
+            scan_ms = '%.2f' % ((time.time() - start) / (QUERIES // 10) * 1000)
+
+            # Every result of the index has to match the search.
+            for terms in queries[:10]:
+                found = set(search.rank(terms, fetch))
+                if not found <= set(scan(snippets, terms)):
+                    print 'Search results differ from scanning!'
+                    sys.exit(1)
+
+        print '%9d %12.2f %12.3f %12s %12s %10.1f' % (
+            count, index_time / count * 1e6, search_time / QUERIES * 1000,
+            datastore_ms, scan_ms, float(results) / QUERIES)
+
+if __name__ == '__main__':
+    main()
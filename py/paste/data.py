@@ -10,17 +10,204 @@
 Data classes include data models and Django forms.
 """
 
+import datetime, hashlib, zlib
+
+from django import newforms as forms
+
+from google.appengine.api import memcache
 from google.appengine.ext import db
 
 from google.appengine.ext.webapp import template
 from google.appengine.ext.db import djangoforms
 
+import highlight, search
+
+# The number of snippets in the list of recent snippets.
+RECENT_COUNT = 10
+
+# Memcache keys of the list of recent snippets and of the pages and fragments
+# that show it. They are deleted whenever a snippet is saved.
+RECENT_KEY = 'recent_snippets'
+RECENT_HTML_KEY = 'html:recent'
+HOME_HTML_KEY = 'html:home'
+
+# The memcache key of the page of a snippet, formatted with the id of the
+# snippet. It's deleted whenever a comment is added to the snippet.
+SNIPPET_HTML_KEY = 'html:snippet:%d'
+
+# The number of comments that are loaded at a time.
+COMMENTS_PER_PAGE = 20
+
+# Cursors of pages of comments count microseconds from this time.
+EPOCH = datetime.datetime(1970, 1, 1)
+
+def recent_snippets():
+    """Returns a list of the most recently added snippets, from memcache if
+    possible.
+    """
+
+    snippets = memcache.get(RECENT_KEY)
+    if snippets is None:
+        snippets = CodeSnippet.all().order('-added').fetch(RECENT_COUNT)
+        memcache.set(RECENT_KEY, snippets)
+    return snippets
+
+class CodeBody(db.Model):
+    """The code of snippets and the code as highlighted HTML, compressed.
+    Bodies are stored under the SHA-1 hash of the code, so snippets with the
+    same code share a body, and they never change once stored.
+    """
+
+    code = db.BlobProperty(required = True)
+    html = db.BlobProperty(required = True)
+
+    @staticmethod
+    def key_name(code):
+        return 'sha1:' + hashlib.sha1(code.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def store(cls, code):
+        """Stores a body for the code unless there already is one, and
+        returns its key name.
+        """
+
+        key_name = cls.key_name(code)
+        if not cls.get_by_key_name(key_name):
+            # Two requests storing the same code at the same time store the
+            # same body, so there is no need for a transaction.
+            html = highlight.highlight(code)
+            cls(key_name = key_name,
+                code = db.Blob(zlib.compress(code.encode('utf-8'))),
+                html = db.Blob(zlib.compress(html.encode('utf-8')))).put()
+        return key_name
+
+    def get_code(self):
+        return zlib.decompress(self.code).decode('utf-8')
+
+    def get_html(self):
+        return zlib.decompress(self.html).decode('utf-8')
+
 class CodeSnippet(db.Model):
-    code = db.TextProperty(required = True)
     title = db.StringProperty()
     author = db.UserProperty()
     added = db.DateTimeProperty(auto_now_add = True)
 
+    # The key name of the CodeBody with the code of the snippet, the last
+    # time a comment was added and the number of comments. Snippets saved
+    # before the comments were counted have a count of None.
+    body = db.StringProperty()
+    modified = db.DateTimeProperty()
+    comment_count = db.IntegerProperty()
+
+    # Snippets saved before there were bodies have their code and
+    # highlighted code here instead. They are moved to a body by upgrade.
+    legacy_code = db.TextProperty(name = 'code')
+    legacy_html = db.TextProperty(name = 'code_html')
+
+    def __init__(self, *args, **kwargs):
+        code = kwargs.pop('code', None)
+        super(CodeSnippet, self).__init__(*args, **kwargs)
+
+        # The code is stored in the body when the snippet is saved. The body
+        # is only loaded when the code is used. db keeps the values of the
+        # body and legacy_code properties in _body and _code, so the names of
+        # these attributes must not clash with those.
+        self._code_cache = code
+        self._loaded_body = None
+
+    def get_body(self):
+        if self._loaded_body is None and self.body:
+            self._loaded_body = CodeBody.get_by_key_name(self.body)
+        return self._loaded_body
+
+    def get_code(self):
+        if self._code_cache is None:
+            if self.body:
+                self._code_cache = self.get_body().get_code()
+            else:
+                self._code_cache = self.legacy_code
+        return self._code_cache
+
+    def set_code(self, code):
+        self._code_cache = code
+        self._loaded_body = None
+        self.body = None
+
+    code = property(get_code, set_code)
+
+    def get_code_html(self):
+        """Returns the code as highlighted HTML."""
+        if self.body:
+            return self.get_body().get_html()
+        return self.legacy_html or highlight.highlight(self.code)
+
+    code_html = property(get_code_html)
+
+    def needs_upgrade(self):
+        return not self.body or self.comment_count is None
+
+    def upgrade(self):
+        """Moves the code of a snippet saved before there were bodies to a
+        body, and counts the comments of a snippet saved before they were
+        counted.
+        """
+
+        if self.comment_count is None:
+            self.comment_count = self.comments.count()
+        self.put()
+
+    def put(self):
+        """Saves the snippet, storing its code in a body unless it already
+        is. Saving a new snippet starts its comment count at zero, adds it to
+        the search index and removes everything that lists recent snippets
+        from memcache.
+        """
+
+        new = not self.is_saved()
+        if new and self.comment_count is None:
+            self.comment_count = 0
+        if not self.body:
+            self.body = CodeBody.store(self.code)
+            self.legacy_code = None
+            self.legacy_html = None
+
+        key = super(CodeSnippet, self).put()
+        if new:
+            search.index(key.id(), self.title, self.code)
+            memcache.delete_multi([RECENT_KEY, RECENT_HTML_KEY, HOME_HTML_KEY])
+        return key
+
+    def last_modified(self):
+        return self.modified or self.added
+
+    def get_comments(self, cursor = None):
+        """Returns a list of at most COMMENTS_PER_PAGE comments in the order
+        they were added, starting at the cursor, and a cursor for the next
+        page, which is None if there are no more comments.
+
+        The cursor is the time the last comment of the previous page was
+        added, in microseconds since EPOCH. One comment more than a page is
+        read to tell whether there is a next page, which a datastore cursor
+        can't do without reading that comment again.
+        """
+
+        query = self.comments.order('added')
+        try:
+            query.filter('added >',
+                         EPOCH + datetime.timedelta(microseconds = int(cursor)))
+        except (TypeError, ValueError, OverflowError):
+            pass
+
+        comments = query.fetch(COMMENTS_PER_PAGE + 1)
+        if len(comments) <= COMMENTS_PER_PAGE:
+            return comments, None
+
+        comments = comments[:COMMENTS_PER_PAGE]
+        delta = comments[-1].added - EPOCH
+        cursor = ((delta.days * 86400 + delta.seconds) * 1000000 +
+                  delta.microseconds)
+        return comments, str(cursor)
+
     def create_url(self, request = None):
         """Returns the absolute URL to the snippet, based on the supplied
         request.
@@ -33,9 +220,20 @@ class CodeSnippet(db.Model):
             return '/' + key
 
 class CodeSnippetForm(djangoforms.ModelForm):
+    # The code isn't a property of snippets, since it's stored in a body.
+    code = forms.CharField(widget = forms.Textarea)
+
     class Meta:
         model = CodeSnippet
-        exclude = ['author']
+        exclude = ['author', 'body', 'modified', 'comment_count',
+                   'legacy_code', 'legacy_html']
+
+    def save(self, commit = True):
+        snippet = super(CodeSnippetForm, self).save(commit = False)
+        snippet.code = self.cleaned_data['code']
+        if commit:
+            snippet.put()
+        return snippet
 
 class Comment(db.Model):
     snippet = db.ReferenceProperty(reference_class = CodeSnippet,
@@ -44,6 +242,36 @@ class Comment(db.Model):
     author = db.UserProperty()
     added = db.DateTimeProperty(auto_now_add = True)
 
+    def put(self):
+        """Saves the comment and marks its snippet as modified, counting the
+        comment if it's new and removing the page of the snippet from
+        memcache.
+        """
+
+        new = not self.is_saved()
+        key = super(Comment, self).put()
+
+        def update_snippet(snippet_key):
+            snippet = db.get(snippet_key)
+            if new and snippet.comment_count is not None:
+                snippet.comment_count += 1
+            if not snippet.modified or snippet.modified < self.added:
+                snippet.modified = self.added
+            snippet.put()
+
+        # Storing the code of a snippet saved before there were bodies puts a
+        # body, which is in another entity group, so it has to be done before
+        # the transaction. A snippet that was set on the comment as an object
+        # is not read again here.
+        snippet = self.snippet
+        if not snippet.body:
+            snippet.put()
+
+        snippet_key = snippet.key()
+        db.run_in_transaction(update_snippet, snippet_key)
+        memcache.delete(SNIPPET_HTML_KEY % snippet_key.id())
+        return key
+
 class CommentForm(djangoforms.ModelForm):
     class Meta:
         model = Comment
@@ -0,0 +1,91 @@
+#
+# Copyright (c) 2008 Andreas Blixt <andreas@blixt.org>
+#
+# License: MIT license <http://www.opensource.org/licenses/mit-license.php>
+# Project homepage: <http://code.google.com/p/blixt/>
+#
+
+"""Syntax highlighting of code snippets.
+
+Code is split into tokens the same way js/prettify.js does it for the C-like
+languages, Python, Perl, Ruby and shell scripts, and the tokens are wrapped in
+<span> tags with the class names that prettify.js uses, so that the same
+style sheet applies. Snippets are highlighted once when they're saved instead
+of in the browser for every view.
+"""
+
+import cgi, re
+
+KEYWORDS = frozenset((
+    # C and C++
+    'abstract bool break case catch char class const const_cast continue '
+    'default delete deprecated dllexport dllimport do double dynamic_cast '
+    'else enum explicit extern false float for friend goto if inline int '
+    'long mutable naked namespace new noinline noreturn nothrow novtable '
+    'operator private property protected public register reinterpret_cast '
+    'return selectany short signed sizeof static static_cast struct switch '
+    'template this thread throw true try typedef typeid typename union '
+    'unsigned using uuid virtual void volatile while typeof '
+    # C#
+    'as base by byte checked decimal delegate descending event finally fixed '
+    'foreach from group implicit in interface internal into is lock null '
+    'object out override orderby params readonly ref sbyte sealed stackalloc '
+    'string select uint ulong unchecked unsafe ushort var '
+    # Java
+    'package synchronized boolean implements import throws instanceof '
+    'transient extends final strictfp native super '
+    # JavaScript
+    'debugger export function with NaN Infinity '
+    # Perl
+    'require sub unless until use elsif BEGIN END '
+    # Python
+    'and assert def del elif except exec global lambda not or pass print '
+    'raise yield False True None '
+    # Ruby
+    'then end begin rescue ensure module when undef next redo retry alias '
+    'defined '
+    # Shell
+    'done fi').split())
+
+# The alternatives are tried in order at every position in the code.
+TOKENS = re.compile(r'''
+    (?P<com>\#[^\r\n]*|//[^\r\n]*|/\*.*?(?:\*/|$))
+  | (?P<str>"""(?:.*?""")?|\'\'\'(?:.*?\'\'\')?
+      |"(?:[^"\\\r\n]|\\.)*"?|'(?:[^'\\\r\n]|\\.)*'?
+      |`(?:[^`\\]|\\.)*`?)
+  | (?P<lit>(?:0x[0-9a-fA-F]+|\d+(?:\.\d*)?|\.\d+)(?:[eE][+-]?\d+)?\w*
+      |@\w+)
+  | (?P<word>[A-Za-z_$][\w$]*)
+  | (?P<pun>[^\w\s]+)
+  | (?P<pln>\s+|.)
+''', re.DOTALL | re.VERBOSE)
+
+# Identifiers that look like the names of types.
+TYPE = re.compile(r'[A-Z][A-Z0-9_]*[a-z][\w$]*$')
+
+def tokenize(code):
+    """Yields a (class name, text) tuple for every token in the code."""
+    for match in TOKENS.finditer(code):
+        kind, text = match.lastgroup, match.group()
+        if kind == 'word':
+            if text in KEYWORDS:
+                kind = 'kwd'
+            elif TYPE.match(text):
+                kind = 'typ'
+            else:
+                kind = 'pln'
+        yield kind, text
+
+def highlight(code):
+    """Returns the code as HTML, with every token wrapped in a <span> tag.
+    Whitespace is left outside of the tags.
+    """
+
+    html = []
+    for kind, text in tokenize(code):
+        text = cgi.escape(text)
+        if kind == 'pln' and text.isspace():
+            html.append(text)
+        else:
+            html.append('<span class="%s">%s</span>' % (kind, text))
+    return ''.join(html)
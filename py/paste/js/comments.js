@@ -0,0 +1,52 @@
+// Loads further pages of comments in place when a "More comments" link is
+// clicked, instead of following the link.
+// Andreas Blixt <andreas@blixt.org>
+(function () {
+    var request = function () {
+        if (window.XMLHttpRequest) return new XMLHttpRequest();
+        return new ActiveXObject('Microsoft.XMLHTTP');
+    };
+
+    var load = function (link) {
+        var more = link.parentNode, xhr = request();
+        link.innerHTML = 'Loading comments...';
+
+        xhr.onreadystatechange = function () {
+            if (xhr.readyState != 4) return;
+            if (xhr.status != 200) {
+                link.innerHTML = 'More comments';
+                return;
+            }
+
+            // The page of comments replaces the paragraph with the link, and
+            // has a link to the page after it if there is one.
+            var holder = document.createElement('div');
+            holder.innerHTML = xhr.responseText;
+            while (holder.firstChild) {
+                more.parentNode.insertBefore(holder.firstChild, more);
+            }
+            more.parentNode.removeChild(more);
+        };
+
+        xhr.open('GET', link.href, true);
+        xhr.send(null);
+    };
+
+    var click = function (e) {
+        e = e || window.event;
+        var target = e.target || e.srcElement;
+        if (target.nodeName != 'A' || !target.parentNode ||
+            target.parentNode.className != 'more-comments') return true;
+
+        load(target);
+        if (e.preventDefault) e.preventDefault();
+        e.returnValue = false;
+        return false;
+    };
+
+    if (document.addEventListener) {
+        document.addEventListener('click', click, false);
+    } else {
+        document.attachEvent('onclick', click);
+    }
+})();
@@ -11,20 +11,36 @@ Registers the WSGI web application with request handlers, also defined
 in this file.
 """
 
-import wsgiref.handlers
+import urllib, wsgiref.handlers
 
-from google.appengine.api import users
+from google.appengine.api import memcache, users
 from google.appengine.ext import webapp
+from google.appengine.ext.webapp import template
 
-import data, util
+import data, search, util
+
+# The number of seconds rendered pages and fragments are cached for, which
+# keeps the times shown in them from getting too far off.
+CACHE_TIME = 60
+
+# The number of snippets shown on every page of search results, and the
+# number of snippets handled by every request to a BatchPage.
+RESULTS_PER_PAGE = 10
+BATCH_SIZE = 50
+
+def recent_html():
+    """Returns the rendered list of recent snippets."""
+    return util.cached_render(data.RECENT_HTML_KEY, 'recent.html',
+        lambda: {'recent_snippets': data.recent_snippets()}, CACHE_TIME)
 
 class HomePage(util.ExtendedHandler):
     def get(self):
-        recent_snippets = data.CodeSnippet.gql('ORDER BY added DESC LIMIT 10')
-        self.template('home.html', {
+        # The form is empty, so the page is the same for everyone except for
+        # the login/logout links.
+        self.cached_template(data.HOME_HTML_KEY, 'home.html', lambda: {
             'form': data.CodeSnippetForm(auto_id = True),
-            'recent_snippets': recent_snippets
-        })
+            'recent_html': recent_html()
+        }, CACHE_TIME)
 
     def head(self):
         # I would like to send the len() of the get() request here, but
@@ -42,38 +58,83 @@ class HomePage(util.ExtendedHandler):
                 'snippet_url': snippet.create_url(self.request)
             })
         else:
-            recent_snippets = data.CodeSnippet.gql('ORDER BY added DESC LIMIT 10')
             self.template('home.html', {
                 'form': form,
-                'recent_snippets': recent_snippets
+                'recent_html': recent_html()
             })
 
 class CodeSnippetPage(util.ExtendedHandler):
     def get_snippet(self):
         return data.CodeSnippet.get_by_id(int(self.request.path_info_peek()))
 
+    def get_values(self, snippet, form):
+        # Snippets saved before their code was stored in a body or before
+        # comments were counted are upgraded the first time they're shown.
+        if snippet.needs_upgrade():
+            snippet.upgrade()
+
+        comment_list, comment_cursor = snippet.get_comments()
+        return {
+            'snippet': snippet,
+            'form': form,
+            'comment_list': comment_list,
+            'comment_cursor': comment_cursor
+        }
+
+    def get_page(self):
+        """Returns a (last modified, HTML) tuple for the page of the snippet,
+        rendered with an empty comment form and without the login/logout
+        links, or None if there is no such snippet. The page is taken from
+        memcache if possible.
+        """
+
+        snippet_id = int(self.request.path_info_peek())
+        key = data.SNIPPET_HTML_KEY % snippet_id
+
+        page = memcache.get(key)
+        if page is None:
+            snippet = data.CodeSnippet.get_by_id(snippet_id)
+            if not snippet:
+                return None
+
+            html = util.render_page('snippet.html', self.get_values(
+                snippet, data.CommentForm(auto_id = True)))
+            page = (snippet.last_modified(), html)
+            memcache.set(key, page, CACHE_TIME)
+        return page
+
     def output(self, snippet, form):
         if snippet:
-            comment_list = snippet.comments.order('added').fetch(1000)
-            self.template('snippet.html', {
-                'snippet': snippet,
-                'form': form,
-                'comment_list': comment_list
-            })
+            self.template('snippet.html', self.get_values(snippet, form))
         else:
             self.template('not-found.html')
 
     def get(self):
-        self.output(self.get_snippet(), data.CommentForm(auto_id = True))
+        page = self.get_page()
+        if not page:
+            self.template('not-found.html')
+            return
+
+        modified, html = page
+        if not self.validate_cache(self.request.path_info_peek(), modified):
+            self.write_page(html)
 
     def head(self):
-        # I would like to send the len() of the get() request here, but
-        # apparently altering the Content-Length header is disallowed.
-        pass
+        # The Content-Length header can't be set, but the headers that make
+        # conditional requests possible can.
+        page = self.get_page()
+        if page:
+            self.validate_cache(self.request.path_info_peek(), page[0])
+        else:
+            self.error(404)
 
     def post(self):
         snippet = self.get_snippet()
-        
+        if not snippet:
+            self.error(404)
+            self.template('not-found.html')
+            return
+
         form = data.CommentForm(data = self.request.POST, auto_id = True)
         if form.is_valid():
             comment = form.save(commit = False)
@@ -81,12 +142,105 @@ class CodeSnippetPage(util.ExtendedHandler):
             comment.snippet = snippet
             comment.put()
 
+            # Redirect, so that the page is loaded again with the comment and
+            # reloading it doesn't post the comment twice.
+            self.redirect(snippet.create_url(self.request))
+            return
+
         self.output(snippet, form)
 
+class CommentsPage(util.ExtendedHandler):
+    """Outputs a page of the comments of a snippet, which js/comments.js
+    loads into the page of the snippet.
+    """
+
+    def get(self):
+        snippet = data.CodeSnippet.get_by_id(int(self.request.path_info_peek()))
+        if not snippet:
+            self.error(404)
+            return
+
+        comment_list, comment_cursor = snippet.get_comments(
+            self.request.get('cursor'))
+        self.response.out.write(template.render('comments.html', {
+            'snippet': snippet,
+            'comment_list': comment_list,
+            'comment_cursor': comment_cursor
+        }))
+
+class SearchPage(util.ExtendedHandler):
+    def get(self):
+        query = self.request.get('q')
+        try:
+            page = max(int(self.request.get('page', 1)), 1)
+        except ValueError:
+            page = 1
+
+        snippet_ids = search.search(query)
+        start = (page - 1) * RESULTS_PER_PAGE
+        end = start + RESULTS_PER_PAGE
+
+        results = []
+        if start < len(snippet_ids):
+            results = data.CodeSnippet.get_by_id(snippet_ids[start:end])
+
+        self.template('search.html', {
+            'query': query,
+            'results': [snippet for snippet in results if snippet],
+            'first': start + 1,
+            'previous_page': page > 1 and page - 1,
+            'next_page': end < len(snippet_ids) and page + 1
+        })
+
+class BatchPage(util.ExtendedHandler):
+    """Calls process for BATCH_SIZE snippets, starting at a cursor, and
+    links to the next batch. Used to update the snippets saved before a
+    change to how snippets are stored. Subclasses define process.
+    """
+
+    def process(self, snippet):
+        """Updates a single snippet."""
+
+    def get(self):
+        query = data.CodeSnippet.all().order('__key__')
+        cursor = self.request.get('cursor')
+        if cursor:
+            query.with_cursor(cursor)
+
+        snippets = query.fetch(BATCH_SIZE)
+        for snippet in snippets:
+            self.process(snippet)
+
+        self.response.headers['Content-Type'] = 'text/html'
+        if len(snippets) < BATCH_SIZE:
+            self.response.out.write('All snippets have been processed.')
+        else:
+            self.response.out.write(
+                'Processed %d snippets. <a href="?cursor=%s">Continue</a>' % (
+                len(snippets), urllib.quote(query.cursor())))
+
+class IndexPage(BatchPage):
+    """Adds the snippets saved before there was a search index to it."""
+    def process(self, snippet):
+        search.index(snippet.key().id(), snippet.title, snippet.code)
+
+class UpgradePage(BatchPage):
+    """Moves the code of snippets saved before there were bodies to bodies.
+    Snippets that aren't upgraded here are upgraded when they're shown.
+    """
+
+    def process(self, snippet):
+        if snippet.needs_upgrade():
+            snippet.upgrade()
+
 def main():
     application = webapp.WSGIApplication([
         ('/', HomePage),
-        ('/\\d+', CodeSnippetPage)
+        ('/\\d+', CodeSnippetPage),
+        ('/\\d+/comments', CommentsPage),
+        ('/search', SearchPage),
+        ('/admin/index', IndexPage),
+        ('/admin/upgrade', UpgradePage)
     ], debug = True)
     wsgiref.handlers.CGIHandler().run(application)
 
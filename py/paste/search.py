@@ -0,0 +1,171 @@
+#
+# Copyright (c) 2008 Andreas Blixt <andreas@blixt.org>
+#
+# License: MIT license <http://www.opensource.org/licenses/mit-license.php>
+# Project homepage: <http://code.google.com/p/blixt/>
+#
+
+"""Full-text search over code snippets.
+
+The title and code of a snippet are split into terms by tokenize(), which
+also splits identifiers such as getUserName and MAX_SPEED into their parts so
+that they can be found by any of them. Every term of a snippet is stored as a
+Posting with a score for how much of the snippet the term makes up. The
+datastore index over the term and score of postings is the inverted index: a
+search reads the best POSTINGS_PER_TERM postings of each of its terms, so it
+costs the same no matter how many snippets there are.
+
+Usage:
+>>> index(snippet.key().id(), snippet.title, snippet.code)
+>>> snippet_ids = search('parse url')
+"""
+
+import hashlib, math, re
+
+from google.appengine.api import memcache
+from google.appengine.ext import db
+
+# Terms shorter than this are not indexed. Words longer than MAX_LENGTH, such
+# as long hex or base64 literals, are skipped along with their parts, since
+# nobody searches for them and the datastore can't store them as terms.
+MIN_LENGTH = 2
+MAX_LENGTH = 100
+
+# The most terms indexed for a snippet. The terms with the highest scores are
+# kept.
+MAX_TERMS = 200
+
+# How many times more a term in the title counts than a term in the code.
+TITLE_WEIGHT = 5
+
+# The number of postings read for every term of a search, and the most terms
+# of a search that are used.
+POSTINGS_PER_TERM = 200
+MAX_QUERY_TERMS = 8
+
+# The number of seconds the results of a search are cached for.
+CACHE_TIME = 60
+
+WORD = re.compile(r'[A-Za-z0-9_]+')
+PART = re.compile(r'[A-Z]+(?![a-z])|[A-Z]?[a-z]+|[0-9]+')
+
+class Posting(db.Model):
+    """A term of a snippet. The key name is made from the id of the snippet
+    and the term, so that indexing a snippet again overwrites its postings.
+    """
+
+    term = db.StringProperty(required = True)
+    snippet_id = db.IntegerProperty(required = True)
+    score = db.FloatProperty(required = True)
+
+def tokenize(text):
+    """Yields the terms of a text in lowercase. Identifiers in camel case or
+    with underscores yield the whole identifier followed by its parts.
+    """
+
+    for word in WORD.findall(text):
+        if len(word) > MAX_LENGTH:
+            continue
+
+        term = word.strip('_').lower()
+        if len(term) >= MIN_LENGTH:
+            yield term
+
+        parts = PART.findall(word)
+        if len(parts) > 1:
+            for part in parts:
+                if len(part) >= MIN_LENGTH:
+                    yield part.lower()
+
+def term_scores(title, code):
+    """Returns a dictionary of the terms of a snippet and their scores, with
+    at most MAX_TERMS terms.
+
+    The score of a term grows with the logarithm of how many times the term
+    occurs, and is divided by the square root of the number of terms so that
+    long snippets don't match everything.
+    """
+
+    counts = {}
+    for term in tokenize(title or ''):
+        counts[term] = counts.get(term, 0) + TITLE_WEIGHT
+    for term in tokenize(code or ''):
+        counts[term] = counts.get(term, 0) + 1
+    if not counts:
+        return {}
+
+    norm = math.sqrt(len(counts))
+    scores = [((1 + math.log(count)) / norm, term)
+              for term, count in counts.iteritems()]
+    scores.sort(reverse = True)
+    return dict([(term, score) for score, term in scores[:MAX_TERMS]])
+
+def index(snippet_id, title, code):
+    """Adds a snippet to the index."""
+    postings = []
+    for term, score in term_scores(title, code).iteritems():
+        postings.append(Posting(key_name = 't%d:%s' % (snippet_id, term),
+                                term = term, snippet_id = snippet_id,
+                                score = score))
+    if postings:
+        db.put(postings)
+
+def fetch_postings(term, limit):
+    """Returns a list of (snippet id, score) tuples of the best postings of a
+    term, best first.
+    """
+
+    query = Posting.all().filter('term =', term).order('-score')
+    return [(p.snippet_id, p.score) for p in query.fetch(limit)]
+
+def query_terms(query):
+    """Returns the unique terms of a search, in the order they appear."""
+    terms = []
+    for term in tokenize(query):
+        if term not in terms:
+            terms.append(term)
+    return terms[:MAX_QUERY_TERMS]
+
+def rank(terms, fetch = fetch_postings):
+    """Returns the ids of the snippets that match any of the terms, best
+    first. fetch is called with a term and POSTINGS_PER_TERM, and should
+    return the best postings of the term like fetch_postings does.
+
+    Snippets that match more of the terms come first. Among snippets that
+    match as many terms, the sum of the scores of the terms decides, where
+    the score of a term that few snippets have is worth more.
+    """
+
+    matches = {}
+    for term in terms:
+        postings = fetch(term, POSTINGS_PER_TERM)
+        if not postings:
+            continue
+
+        # A term that fills all the postings read is common, and counts the
+        # least.
+        weight = math.log(1.0 + float(POSTINGS_PER_TERM) / len(postings))
+        for snippet_id, score in postings:
+            count, total = matches.get(snippet_id, (0, 0.0))
+            matches[snippet_id] = (count + 1, total + score * weight)
+
+    ranked = [(match, -snippet_id)
+              for snippet_id, match in matches.iteritems()]
+    ranked.sort(reverse = True)
+    return [-negated_id for match, negated_id in ranked]
+
+def search(query):
+    """Returns the ids of the snippets matching a search, best first. The
+    result is cached, so that getting further pages of results is cheap.
+    """
+
+    terms = query_terms(query)
+    if not terms:
+        return []
+
+    key = 'search:' + hashlib.md5(' '.join(terms)).hexdigest()
+    snippet_ids = memcache.get(key)
+    if snippet_ids is None:
+        snippet_ids = rank(terms)
+        memcache.set(key, snippet_ids, CACHE_TIME)
+    return snippet_ids
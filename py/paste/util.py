@@ -8,11 +8,39 @@
 """Utility classes and functions for Google App Engine applications.
 """
 
-from google.appengine.api import users
+import calendar, hashlib, time
+
+from google.appengine.api import memcache, users
 from google.appengine.ext import webapp
 
 from google.appengine.ext.webapp import template
 
+# Marks where the login/logout links go in pages rendered by render_page.
+USER_PLACEHOLDER = '<!-- user -->'
+
+HTTP_DATE = '%a, %d %b %Y %H:%M:%S GMT'
+
+def cached_render(key, tpath, get_values, time = 0):
+    """Returns the output of a template from memcache, rendering and caching
+    it if it isn't there. get_values is only called if the template has to be
+    rendered, and should return the values for it.
+    """
+
+    html = memcache.get(key)
+    if html is None:
+        html = template.render(tpath, get_values())
+        memcache.set(key, html, time)
+    return html
+
+def render_page(tpath, values):
+    """Renders a page without the login/logout links, which are put in place
+    by ExtendedHandler.write_page. Pages rendered this way are the same for
+    every user and can be cached.
+    """
+
+    values['user_placeholder'] = USER_PLACEHOLDER
+    return template.render(tpath, values)
+
 class ExtendedHandler(webapp.RequestHandler):
     """An extension to the webapp RequestHandler which automatically handles
     exceptions and enables various shortcuts.
@@ -28,8 +56,9 @@ class ExtendedHandler(webapp.RequestHandler):
         else:
             self.template('error.html')
 
-    def template(self, tpath, values = {}):
-        """A shortcut for outputting a template.
+    def user_values(self, values):
+        """Adds the current user and a login or logout URL to values, and
+        returns them.
         """
 
         path = self.request.path_qs
@@ -41,4 +70,77 @@ class ExtendedHandler(webapp.RequestHandler):
         else:
             values['login_url'] = users.create_login_url(path)
 
+        return values
+
+    def template(self, tpath, values = {}):
+        """A shortcut for outputting a template.
+        """
+
+        self.user_values(values)
         self.response.out.write(template.render(tpath, values))
+
+    def cached_template(self, key, tpath, get_values, time = 0):
+        """Outputs a template like template does, but takes the page from
+        memcache if it's there. get_values is only called if the page has to
+        be rendered, and should return the values for the template.
+
+        The page is cached without the login/logout links, since they are the
+        only part of it that differs between users. They are rendered from
+        user.html for every request.
+        """
+
+        html = memcache.get(key)
+        if html is None:
+            html = render_page(tpath, get_values())
+            memcache.set(key, html, time)
+        self.write_page(html)
+
+    def write_page(self, html):
+        """Outputs a page rendered by render_page, with the login/logout
+        links of the current user.
+        """
+
+        user = template.render('user.html', self.user_values({}))
+        self.response.out.write(html.replace(USER_PLACEHOLDER, user, 1))
+
+    def validate_cache(self, tag, modified):
+        """Sets the ETag and Last-Modified headers of the response for a page
+        identified by tag, which was last changed at the datetime modified
+        (in UTC). Since pages show the login/logout links of the current
+        user, the ETag also depends on the user.
+
+        Returns True if the client already has the page, in which case the
+        status is set to 304 and nothing else should be output.
+        """
+
+        tag = '%s-%d' % (tag, calendar.timegm(modified.timetuple()))
+        user = users.get_current_user()
+        if user:
+            tag = '%s-%s' % (tag, hashlib.md5(user.email()).hexdigest()[:8])
+        etag = '"%s"' % tag
+        last_modified = modified.strftime(HTTP_DATE)
+
+        headers = self.response.headers
+        headers['Cache-Control'] = 'private'
+        headers['ETag'] = etag
+        headers['Last-Modified'] = last_modified
+
+        # If-None-Match is used over If-Modified-Since when both are sent,
+        # since only the ETag changes with the user.
+        match = self.request.headers.get('If-None-Match')
+        since = self.request.headers.get('If-Modified-Since')
+        if match:
+            tags = [t.strip() for t in match.split(',')]
+            fresh = etag in tags or '*' in tags
+        elif since:
+            try:
+                since = time.strptime(since.split(';')[0].strip(), HTTP_DATE)
+                fresh = modified.timetuple()[:6] <= since[:6]
+            except ValueError:
+                fresh = False
+        else:
+            fresh = False
+
+        if fresh:
+            self.response.set_status(304)
+        return fresh
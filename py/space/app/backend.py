@@ -0,0 +1,373 @@
+# -*- coding: cp1252 -*-
+#
+# Copyright (c) 2008 Andreas Blixt <andreas@blixt.org>
+#
+# Project location:
+# /svn/trunk/py/space/ @ <http://code.google.com/p/blixt/>
+#
+# License: MIT license <http://www.opensource.org/licenses/mit-license.php>
+#
+
+"""Storage backends for the state of the Space world.
+
+The whole world (all clients and their entities) is stored as a single blob,
+so restoring a session costs one read no matter how many clients are
+connected. Writers use compare-and-set, so two requests saving the world at
+the same time can't silently overwrite each other.
+
+Two backends are available: MemcacheBackend for App Engine, and LocalBackend
+which keeps everything in the current process and is meant for tests and
+tools. Both hand out entity ids through an IdAllocator.
+"""
+
+from google.appengine.api import memcache
+import cPickle as pickle
+import threading, time, zlib
+
+import stats
+
+# Identifies the encoding of world blobs. Blobs in any other format are
+# treated as missing.
+FORMAT = 1
+
+class World(object):
+    """The state of the world as stored by a backend.
+
+    The clients dictionary maps auth keys to the data of each client, which is
+    a (entities, store) tuple, or None for clients that have not saved any
+    data yet. The version is increased every time the world is saved. The time
+    is that of the last tick run by the tick engine, if any, and commands are
+    the queued commands the engine has not applied yet. Hits are the
+    projectiles that hit a player during the last run of the engine.
+
+    Reconciled is the time the clients were last compared with the client
+    records in the datastore, and orphans the records that had no client at
+    that time (see the presence module).
+    """
+
+    # Worlds saved before these existed don't have these attributes.
+    commands = ()
+    hits = ()
+    orphans = frozenset()
+    reconciled = 0.0
+    time = None
+
+    # Whether the world replaces a blob that was stored when it was loaded.
+    # This is not saved with the world.
+    stored = False
+
+    def __init__(self):
+        self.clients = {}
+        self.version = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('stored', None)
+        return state
+
+def encode_world(world):
+    """Returns the world encoded as a compressed string."""
+    return chr(FORMAT) + zlib.compress(pickle.dumps(world, 2))
+
+def decode_world(blob):
+    """Returns the world encoded in a string, or None if the string is not in
+    the current format.
+    """
+    if not blob or ord(blob[0]) != FORMAT:
+        return None
+    return pickle.loads(zlib.decompress(blob[1:]))
+
+class IdAllocator(object):
+    """Hands out entity ids from blocks leased from a counter in a backend.
+
+    Each process leases a block of ids at a time, so the shared counter is
+    only increased once every BLOCK_SIZE ids instead of for every entity.
+    Ids are unique across processes, but not handed out in order.
+
+    Usage:
+    >>> ids = IdAllocator(backend)
+    >>> ids.next_id()
+    1
+    """
+
+    BLOCK_SIZE = 100
+
+    def __init__(self, backend, key='next_id', block_size=None):
+        self.backend = backend
+        self.key = key
+        self.block_size = block_size or self.BLOCK_SIZE
+        self.block = iter(())
+
+    def next_id(self):
+        # Taking the next value of an iterator is atomic, so threads can share
+        # an allocator without a lock. Threads that run out of ids at the same
+        # time each lease a block of their own.
+        try:
+            return self.block.next()
+        except StopIteration:
+            end = self.backend.incr(self.key, self.block_size)
+            self.block = iter(xrange(end - self.block_size + 1, end + 1))
+            return self.block.next()
+
+class Backend(object):
+    """The interface of a world storage backend. Backends have an ids
+    attribute with the IdAllocator to use for new entities.
+    """
+
+    def load_world(self):
+        """Returns the stored world, or a new world if there is none."""
+        raise NotImplementedError()
+
+    def save_world(self, world):
+        """Saves a world previously returned by load_world and increases its
+        version.
+
+        Returns False without saving if the world was saved by somebody else
+        since it was loaded.
+        """
+        raise NotImplementedError()
+
+    def get(self, key):
+        raise NotImplementedError()
+
+    def set(self, key, value):
+        raise NotImplementedError()
+
+    def delete_multi(self, keys, key_prefix=''):
+        raise NotImplementedError()
+
+    def incr(self, key, delta=1, initial_value=0):
+        raise NotImplementedError()
+
+    def push(self, name, value):
+        """Appends a value to the end of a queue."""
+        raise NotImplementedError()
+
+    def pop_all(self, name):
+        """Removes and returns all values in a queue, oldest first. Only one
+        consumer may pop from a queue at a time.
+        """
+        raise NotImplementedError()
+
+    def acquire(self, name, seconds):
+        """Tries to take a lease that expires after a number of seconds.
+        Returns True if the lease was taken.
+        """
+        raise NotImplementedError()
+
+    def release(self, name):
+        """Gives up a lease taken with acquire."""
+        raise NotImplementedError()
+
+    def shard(self, index):
+        """Returns a backend of the same kind for the world of a shard. The
+        backend has keys of its own but shares the id allocator of this one,
+        so that ids stay unique across shards.
+        """
+        raise NotImplementedError()
+
+class MemcacheBackend(Backend):
+    """Stores the world in memcache under a single key.
+
+    All keys used by the backend start with the prefix, so that several
+    worlds can share memcache. Ids are taken from the allocator passed in, or
+    from a counter under the prefix.
+    """
+
+    def __init__(self, key='world', prefix='', ids=None):
+        self.prefix = prefix
+        self.key = prefix + key
+        self.client = memcache.Client()
+        self.ids = ids or IdAllocator(self)
+
+    def load_world(self):
+        blob = self.client.gets(self.key)
+        stats.mark('world get')
+        world = decode_world(blob)
+        stats.mark('world decode')
+        if blob: stats.count('world bytes', len(blob))
+        if not world:
+            world = World()
+
+        # A blob in an old format is replaced by the new world, so it has to
+        # be saved with cas like any other.
+        world.stored = blob is not None
+        return world
+
+    def save_world(self, world):
+        world.version += 1
+        blob = encode_world(world)
+        stats.mark('world encode')
+
+        if world.stored:
+            saved = self.client.cas(self.key, blob)
+        else:
+            saved = self.client.add(self.key, blob)
+        stats.mark('world cas')
+
+        if saved:
+            world.stored = True
+        else:
+            world.version -= 1
+        return saved
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key, value)
+
+    def delete_multi(self, keys, key_prefix=''):
+        self.client.delete_multi(keys, key_prefix=self.prefix + key_prefix)
+
+    def incr(self, key, delta=1, initial_value=0):
+        return self.client.incr(self.prefix + key, delta,
+                                initial_value=initial_value)
+
+    def push(self, name, value):
+        # Every value gets its own key, numbered by a counter.
+        name = self.prefix + name
+        i = self.client.incr(name + '_head', initial_value=0)
+        self.client.set('%s_%d' % (name, i), value)
+
+    def pop_all(self, name):
+        name = self.prefix + name
+        counters = self.client.get_multi(['head', 'tail', 'missing'],
+                                         key_prefix=name + '_')
+        head = counters.get('head') or 0
+        tail = counters.get('tail') or 0
+        if head <= tail:
+            return []
+
+        keys = [str(i) for i in xrange(tail + 1, head + 1)]
+        found = self.client.get_multi(keys, key_prefix=name + '_')
+
+        values = []
+        for key in keys:
+            if key not in found:
+                # The counter is increased before the value is set, so the
+                # value may just not be there yet. Wait for it once, then
+                # consider it lost. The key that is waited for is kept in
+                # memcache, since every request has a backend of its own.
+                if counters.get('missing') != key:
+                    self.client.set(name + '_missing', key)
+                    break
+            else:
+                values.append(found[key])
+            tail = int(key)
+
+        self.client.set(name + '_tail', tail)
+        self.client.delete_multi([k for k in keys
+                                  if k in found and int(k) <= tail],
+                                 key_prefix=name + '_')
+        return values
+
+    def acquire(self, name, seconds):
+        return self.client.add(self.prefix + name, 1, time=seconds)
+
+    def release(self, name):
+        self.client.delete(self.prefix + name)
+
+    def shard(self, index):
+        return MemcacheBackend(prefix='%sshard%d_' % (self.prefix, index),
+                               ids=self.ids)
+
+class LocalBackend(Backend):
+    """Stores the world in the current process. The world is still encoded
+    when saved, so that loading it returns a separate copy just like
+    memcache would.
+    """
+
+    def __init__(self, ids=None):
+        self.lock = threading.Lock()
+        self.blob = None
+        self.version = 0
+        self.values = {}
+        self.queues = {}
+        self.leases = {}
+        self.shards = {}
+        self.ids = ids or IdAllocator(self)
+
+    def load_world(self):
+        self.lock.acquire()
+        try:
+            world = decode_world(self.blob)
+        finally:
+            self.lock.release()
+
+        if not world:
+            world = World()
+        return world
+
+    def save_world(self, world):
+        self.lock.acquire()
+        try:
+            if world.version != self.version:
+                return False
+
+            world.version += 1
+            self.blob = encode_world(world)
+            self.version = world.version
+            return True
+        finally:
+            self.lock.release()
+
+    def get(self, key):
+        value = self.values.get(key)
+        if value is not None:
+            value = pickle.loads(value)
+        return value
+
+    def set(self, key, value):
+        self.values[key] = pickle.dumps(value, 2)
+
+    def delete_multi(self, keys, key_prefix=''):
+        for key in keys:
+            self.values.pop(key_prefix + key, None)
+
+    def incr(self, key, delta=1, initial_value=0):
+        self.lock.acquire()
+        try:
+            value = self.get(key)
+            if value is None: value = initial_value
+
+            value += delta
+            self.set(key, value)
+            return value
+        finally:
+            self.lock.release()
+
+    def push(self, name, value):
+        self.lock.acquire()
+        try:
+            self.queues.setdefault(name, []).append(pickle.dumps(value, 2))
+        finally:
+            self.lock.release()
+
+    def pop_all(self, name):
+        self.lock.acquire()
+        try:
+            values = self.queues.pop(name, [])
+        finally:
+            self.lock.release()
+        return [pickle.loads(v) for v in values]
+
+    def acquire(self, name, seconds):
+        self.lock.acquire()
+        try:
+            if self.leases.get(name, 0) > time.time():
+                return False
+            self.leases[name] = time.time() + seconds
+            return True
+        finally:
+            self.lock.release()
+
+    def release(self, name):
+        self.leases.pop(name, None)
+
+    def shard(self, index):
+        # Backends only exist in memory, so the same one has to be returned
+        # every time.
+        if index not in self.shards:
+            self.shards[index] = LocalBackend(ids=self.ids)
+        return self.shards[index]
@@ -0,0 +1,169 @@
+# -*- coding: cp1252 -*-
+#
+# Copyright (c) 2008 Andreas Blixt <andreas@blixt.org>
+#
+# Project location:
+# /svn/trunk/py/space/ @ <http://code.google.com/p/blixt/>
+#
+# License: MIT license <http://www.opensource.org/licenses/mit-license.php>
+#
+
+"""Hit detection between projectiles and players.
+
+Detection is done in two phases. The broad phase puts all players in a
+spatial grid, so that each projectile is only tested against the players near
+the path it travelled. The narrow phase treats the projectile and the player
+as circles moving in straight lines and solves for the earliest time they
+touch, which means that a fast projectile can't pass through a player between
+two refreshes. Offsets are measured across the boundaries of the Universe
+when that is shorter, so paths must be shorter than half the Universe.
+"""
+
+from itertools import izip
+import math
+
+import grid, space
+
+class Hit(object):
+    """A projectile hitting a player. The owner is the id of the player that
+    shot the projectile, if known.
+    """
+
+    def __init__(self, time, projectile_id, player_id, owner_id=None):
+        self.time = time
+        self.projectile_id = projectile_id
+        self.player_id = player_id
+        self.owner_id = owner_id
+
+    def __repr__(self):
+        return 'Hit(%r, %r, %r, %r)' % (self.time, self.projectile_id,
+                                        self.player_id, self.owner_id)
+
+def _wrap(d, size):
+    """Returns the offset equivalent to d that is shortest when going across
+    the boundaries of a dimension of the given size.
+    """
+    d %= size
+    if d > size / 2:
+        d -= size
+    return d
+
+def sweep(dx, dy, vx, vy, duration, radius):
+    """Returns the earliest time within the duration at which a point, starting
+    at the offset (dx, dy) from the origin and moving at the velocity
+    (vx, vy), is within radius of the origin. Returns None if it never is.
+    """
+    c = dx * dx + dy * dy - radius * radius
+    if c <= 0:
+        return 0.0
+
+    # Solve |d + v * t| = radius for the smaller t. The point must be moving
+    # towards the origin to ever get close enough.
+    a = vx * vx + vy * vy
+    b = dx * vx + dy * vy
+    if not a or b >= 0:
+        return None
+
+    disc = b * b - a * c
+    if disc < 0:
+        return None
+
+    t = (-b - math.sqrt(disc)) / a
+    if t > duration:
+        return None
+    return t
+
+def detect(players, projectiles, now):
+    """Finds the projectiles that hit a player between their last refresh and
+    the time `now`.
+
+    Players is a list of (id, state) pairs and projectiles a list of
+    (id, state, owner id, expiry time) tuples, with states as returned by
+    get_state() and an expiry time of 0 for projectiles that don't expire.
+    Entities are assumed to move in a straight line from the time of their
+    state. A projectile never hits the player that owns it, and hits at most
+    one player.
+
+    Returns a list of Hit objects, earliest first.
+    """
+    width = float(space.DIMENSION_X)
+    height = float(space.DIMENSION_Y)
+    radius = space.Player.RADIUS + space.Projectile.RADIUS
+
+    # Each projectile looks around the middle of its path, far enough to find
+    # any player that could have crossed it.
+    paths = []
+    for proj_id, state, owner_id, expires in projectiles:
+        t0 = state[5]
+        duration = (expires and min(now, expires) or now) - t0
+        if duration < 0: continue
+
+        half = duration / 2
+        reach = (math.hypot(state[3], state[4]) * half +
+                 space.Player.MAX_SPEED * duration + radius)
+        paths.append((proj_id, state, owner_id, duration,
+                      (state[1] + state[3] * half) % width,
+                      (state[2] + state[4] * half) % height, reach))
+
+    hits = []
+    if not players or not paths:
+        return hits
+
+    # Cells as large as the longest reach keep every lookup down to the
+    # cells next to the one the path is in, no matter how crowded it gets.
+    index = grid.SpatialGrid(max([path[6] for path in paths]), width, height)
+    states = {}
+    for player_id, state in players:
+        dt = now - state[5]
+        index.insert(player_id, (state[1] + state[3] * dt) % width,
+                     (state[2] + state[4] * dt) % height)
+        states[player_id] = state
+
+    for proj_id, state, owner_id, duration, x, y, reach in paths:
+        best = None
+        for player_id in index.query(x, y, reach):
+            if player_id == owner_id: continue
+
+            # The offset from the player to the projectile at the time of the
+            # projectile state, and their relative velocity.
+            p = states[player_id]
+            lag = state[5] - p[5]
+            t = sweep(_wrap(state[1] - (p[1] + p[3] * lag), width),
+                      _wrap(state[2] - (p[2] + p[4] * lag), height),
+                      state[3] - p[3], state[4] - p[4], duration, radius)
+            if t is not None and (best is None or t < best[0]):
+                best = (t, player_id)
+
+        if best:
+            hits.append(Hit(state[5] + best[0], proj_id, best[1], owner_id))
+
+    hits.sort(key=lambda hit: hit.time)
+    return hits
+
+def collide(clients, now):
+    """Detects hits for the projectiles in the stores of clients, and removes
+    the projectiles that hit something. Clients is a list of (entities, store)
+    tuples as kept in the world.
+
+    Returns a list of Hit objects, earliest first.
+    """
+    players = []
+    projectiles = []
+    for entities, store in clients:
+        owner_id = None
+        for ent_id, entity in entities.iteritems():
+            if isinstance(entity, space.Player):
+                players.append((ent_id, entity.get_state()))
+                owner_id = ent_id
+
+        for ent_id, expires in izip(store.ids, store.expires):
+            projectiles.append((ent_id, store.get_state(ent_id), owner_id,
+                                expires))
+
+    hits = detect(players, projectiles, now)
+    if hits:
+        removed = set(hit.projectile_id for hit in hits)
+        for entities, store in clients:
+            for ent_id in [i for i in store.ids if i in removed]:
+                store.remove(ent_id, free=True)
+    return hits
@@ -0,0 +1,147 @@
+# -*- coding: cp1252 -*-
+#
+# Copyright (c) 2008 Andreas Blixt <andreas@blixt.org>
+#
+# Project location:
+# /svn/trunk/py/space/ @ <http://code.google.com/p/blixt/>
+#
+# License: MIT license <http://www.opensource.org/licenses/mit-license.php>
+#
+
+"""Spatial indexing for the Space game.
+
+The Universe wraps around at its boundaries, so an entity close to the left
+edge is also close to entities near the right edge. The grid in this module
+takes that into account for both cell lookups and distances.
+"""
+
+import math
+
+import space
+
+class SpatialGrid(object):
+    """A uniform grid of cells over the Universe, mapping each cell to the
+    ids of the entities inside it.
+
+    Usage:
+    >>> grid = SpatialGrid()
+    >>> grid.insert(player.id, player.position_x, player.position_y)
+    >>> grid.query(player.position_x, player.position_y, 500)
+    [1, 5, 8]
+    """
+
+    CELL_SIZE = 250
+
+    def __init__(self, cell_size=None, width=None, height=None):
+        self.width = float(width or space.DIMENSION_X)
+        self.height = float(height or space.DIMENSION_Y)
+
+        cell_size = cell_size or self.CELL_SIZE
+        self.columns = max(1, int(self.width // cell_size))
+        self.rows = max(1, int(self.height // cell_size))
+        self.cell_width = self.width / self.columns
+        self.cell_height = self.height / self.rows
+
+        self.cells = {}
+        self.positions = {}
+
+    def __contains__(self, ent_id):
+        return ent_id in self.positions
+
+    def __len__(self):
+        return len(self.positions)
+
+    def cell(self, x, y):
+        """Returns the (column, row) of the cell containing a point."""
+        return (int(x // self.cell_width) % self.columns,
+                int(y // self.cell_height) % self.rows)
+
+    def distance(self, x1, y1, x2, y2):
+        """Returns the shortest distance between two points, going across the
+        boundaries of the Universe if that is shorter.
+        """
+        dx = abs(x1 - x2) % self.width
+        dy = abs(y1 - y2) % self.height
+        return math.hypot(min(dx, self.width - dx), min(dy, self.height - dy))
+
+    def insert(self, ent_id, x, y):
+        """Adds an entity to the grid, or moves it if it's already added."""
+        if ent_id in self.positions:
+            self.remove(ent_id)
+
+        self.positions[ent_id] = (x, y)
+        self.cells.setdefault(self.cell(x, y), []).append(ent_id)
+
+    def remove(self, ent_id):
+        """Removes an entity from the grid."""
+        x, y = self.positions.pop(ent_id)
+        key = self.cell(x, y)
+
+        ids = self.cells[key]
+        ids.remove(ent_id)
+        if not ids: del self.cells[key]
+
+    def query(self, x, y, radius):
+        """Returns the ids of all entities within radius of a point."""
+        col, row = self.cell(x, y)
+
+        # The number of cells to look at in each direction, never more than
+        # the whole grid so that no cell is visited twice.
+        reach_x = int(math.ceil(radius / self.cell_width))
+        reach_y = int(math.ceil(radius / self.cell_height))
+        cols = [(col + i) % self.columns for i in
+                xrange(-min(reach_x, self.columns // 2),
+                       min(reach_x, (self.columns - 1) // 2) + 1)]
+        rows = [(row + i) % self.rows for i in
+                xrange(-min(reach_y, self.rows // 2),
+                       min(reach_y, (self.rows - 1) // 2) + 1)]
+
+        result = []
+        for c in cols:
+            for r in rows:
+                for ent_id in self.cells.get((c, r), ()):
+                    ex, ey = self.positions[ent_id]
+                    if self.distance(x, y, ex, ey) <= radius:
+                        result.append(ent_id)
+        return result
+
+class StateGrid(SpatialGrid):
+    """A spatial grid of the (id, state) pairs of entities. It is built once
+    for a world and then queried for the entities near each client.
+
+    Usage:
+    >>> grid = StateGrid(session.iterstates())
+    >>> grid.within(player.position_x, player.position_y, 500)
+    [(1, (0, 510.0, 300.0, ...)), (5, (1, 490.0, 280.0, ...))]
+    """
+
+    def __init__(self, states=(), cell_size=None, width=None, height=None):
+        super(StateGrid, self).__init__(cell_size, width, height)
+
+        self.states = {}
+        for ent_id, state in states:
+            self.add(ent_id, state)
+
+    def add(self, ent_id, state):
+        """Adds the state of an entity to the grid, or replaces it if it's
+        already added.
+        """
+        self.insert(ent_id, state[1], state[2])
+        self.states[ent_id] = state
+
+    def remove(self, ent_id):
+        """Removes an entity from the grid."""
+        super(StateGrid, self).remove(ent_id)
+        del self.states[ent_id]
+
+    def within(self, x, y, radius, extra=()):
+        """Returns the (id, state) pairs of the entities within radius of a
+        point. Extra (id, state) pairs that are not in the grid, such as
+        ghosts, are checked one by one and added if they are close enough.
+        """
+        result = [(ent_id, self.states[ent_id])
+                  for ent_id in self.query(x, y, radius)]
+        for ent_id, state in extra:
+            if self.distance(x, y, state[1], state[2]) <= radius:
+                result.append((ent_id, state))
+        return result
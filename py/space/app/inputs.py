@@ -0,0 +1,171 @@
+# -*- coding: cp1252 -*-
+#
+# Copyright (c) 2008 Andreas Blixt <andreas@blixt.org>
+#
+# Project location:
+# /svn/trunk/py/space/ @ <http://code.google.com/p/blixt/>
+#
+# License: MIT license <http://www.opensource.org/licenses/mit-license.php>
+#
+
+"""Applying player commands at the time they were sent.
+
+Clients stamp every command with the time on their own clock. The time is
+converted to server time with a ClockOffset, which is estimated from the
+PING_REQUEST and PONG commands that clients already send.
+
+Commands that change how a player moves are kept in the InputBuffer of the
+player for WINDOW seconds, together with the motion of the player before
+them. A command that arrives late is put in its place among the buffered
+commands and the motion of the player is replayed, so that the player ends up
+where it would have been if the command had arrived at once. Since motion is
+solved in closed form, a replay costs one step per buffered command. Commands
+sent longer than WINDOW seconds ago are applied as if sent WINDOW seconds ago.
+"""
+
+import bisect
+
+import motion, space
+
+# The attributes that make up the motion of a player.
+_MOTION = ('position_x', 'position_y', 'velocity_x', 'velocity_y',
+           'direction', 'move_mod', 'turn_mod', 'last_refresh')
+
+def save_motion(player):
+    return tuple([getattr(player, name) for name in _MOTION])
+
+def restore_motion(player, saved):
+    for name, value in zip(_MOTION, saved):
+        setattr(player, name, value)
+
+def advance(player, t):
+    """Moves a player to the time t, wrapping it around the boundaries of the
+    Universe.
+    """
+    motion.advance(player, t - player.last_refresh)
+    player.position_x %= space.DIMENSION_X
+    player.position_y %= space.DIMENSION_Y
+    player.last_refresh = t
+
+class ClockOffset(object):
+    """Estimates how far ahead the clock of the server is of the clock of a
+    client.
+
+    The server notes the time it answers a PING_REQUEST, and the client
+    sends a PONG when it gets the answer. The PONG has the client time it was
+    sent at and reaches the server half a round trip later, which gives one
+    sample of the offset. Samples are smoothed to even out jitter.
+    """
+
+    __slots__ = ('offset', 'samples')
+
+    WEIGHT = 0.25
+
+    def __init__(self):
+        self.offset = None
+        self.samples = 0
+
+    def add(self, client_time, server_time, round_trip):
+        sample = server_time - round_trip / 2 - client_time
+        if self.offset is None:
+            self.offset = sample
+        else:
+            self.offset += (sample - self.offset) * self.WEIGHT
+        self.samples += 1
+
+    def __getstate__(self):
+        return self.offset, self.samples
+
+    def __setstate__(self, state):
+        # Offsets pickled before they had slots have a dictionary as state.
+        if isinstance(state, dict):
+            state = state['offset'], state['samples']
+        self.offset, self.samples = state
+
+    def to_server(self, client_time):
+        """Returns the server time for a client time, or None if there is no
+        estimate yet.
+        """
+        if self.offset is None:
+            return None
+        return client_time + self.offset
+
+class InputBuffer(object):
+    """The movement commands a player sent during the last WINDOW seconds.
+
+    Usage:
+    >>> buf = InputBuffer(player)
+    >>> buf.apply(player, space.TURN_LEFT, sent_at, space.now)
+    """
+
+    __slots__ = ('base', 'commands', 'count')
+
+    WINDOW = 0.5
+
+    def __init__(self, player):
+        # The motion of the player before the first buffered command.
+        self.base = save_motion(player)
+        self.commands = []
+        self.count = 0
+
+    def __getstate__(self):
+        return self.base, self.commands, self.count
+
+    def __setstate__(self, state):
+        if isinstance(state, dict):
+            state = state['base'], state['commands'], state['count']
+        self.base, self.commands, self.count = state
+
+    def trim(self, player, cutoff):
+        """Folds the commands before the cutoff into the base motion. The
+        player is left at the time of the cutoff.
+        """
+        restore_motion(player, self.base)
+        while self.commands and self.commands[0][0] <= cutoff:
+            t, i, command = self.commands.pop(0)
+            advance(player, t)
+            player.apply_input(command)
+
+        if cutoff > player.last_refresh:
+            advance(player, cutoff)
+        self.base = save_motion(player)
+
+    def replay(self, player, until):
+        """Moves the player from the base motion to the time until, applying
+        the buffered commands on the way.
+        """
+        restore_motion(player, self.base)
+        for t, i, command in self.commands:
+            if t > until: break
+            advance(player, t)
+            player.apply_input(command)
+        advance(player, until)
+
+    def apply(self, player, command, t, now):
+        """Applies a command as if it was sent at the time t, and moves the
+        player to the time now.
+
+        Returns the time the command was applied at.
+        """
+        self.trim(player, now - self.WINDOW)
+        t = min(max(t, self.base[-1]), now)
+
+        # Commands with the same time keep the order they arrived in.
+        self.count += 1
+        bisect.insort(self.commands, (t, self.count, command))
+
+        self.replay(player, now)
+        return t
+
+    def motion_at(self, player, t, now):
+        """Returns the saved motion of the player at the time t, which is
+        limited to the times commands can be applied at. The player is left
+        at the time now.
+        """
+        self.trim(player, now - self.WINDOW)
+        t = min(max(t, self.base[-1]), now)
+
+        self.replay(player, t)
+        saved = save_motion(player)
+        self.replay(player, now)
+        return saved
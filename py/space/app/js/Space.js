@@ -344,6 +344,7 @@ Space.Net = new Class({
         this.ping = -1;
         this.sentPackets = 0;
         this.service = service;
+        this.snapshot = -1;
 
         this.timer = (function () {
             if (this.auth) {
@@ -368,6 +369,7 @@ Space.Net = new Class({
         var params = req.params;
     
         var authKey = res[Space.Net.AUTH_KEY],
+            baseline = res[Space.Net.BASELINE],
             cmd = params[Space.Net.COMMAND],
             entityData = res[Space.Net.ENTITY_DATA],
             packetId = params[Space.Net.PACKET_ID],
@@ -375,10 +377,30 @@ Space.Net = new Class({
 
         this.ping = $time() - params[Space.Net.TIMESTAMP];
 
-        for (var i in Space.Entity.all) {
-            if (!entityData[i]) Space.Entity.all[i].destroy();
+        if (packetId < this.snapshot) {
+            // A newer snapshot has already been applied.
+            entityData = {};
+        } else if (baseline === undefined) {
+            // Full snapshot; anything not in it no longer exists.
+            for (var i in Space.Entity.all) {
+                if (!entityData[i]) Space.Entity.all[i].destroy();
+            }
+            this.snapshot = packetId;
+        } else {
+            // Delta snapshot; only the listed entities were removed.
+            res[Space.Net.REMOVED].each(function (id) {
+                if (Space.Entity.all[id]) Space.Entity.all[id].destroy();
+            });
+            this.snapshot = packetId;
         }
 
+        // Projectiles that hit a player are gone, even if the snapshot that
+        // removes them hasn't arrived yet.
+        (res[Space.Net.HITS] || []).each(function (hit) {
+            var proj = Space.Entity.all[hit[Space.Net.ENTITY_ID]];
+            if (proj) proj.destroy();
+        });
+
         for (var i in entityData) {
             var d = entityData[i];
             
@@ -455,6 +477,7 @@ Space.Net = new Class({
         params = {};
         params[Space.Net.TIMESTAMP] = $time();
         params[Space.Net.AUTH_KEY] = this.auth;
+        params[Space.Net.BASELINE] = this.snapshot;
         params[Space.Net.COMMAND] = cmd;
         params[Space.Net.PACKET_ID] = packet;
         
@@ -477,16 +500,20 @@ Space.Net = new Class({
 });
 
 Space.Net.AUTH_KEY = 'a';
+Space.Net.BASELINE = 'b';
 Space.Net.COMMAND = 'c';
 Space.Net.DIRECTION = 'd';
 Space.Net.ENTITY_DATA = 'e';
 Space.Net.ENTITY_ID = 'i';
 Space.Net.ENTITY_TYPE = 't';
+Space.Net.HITS = 'h';
+Space.Net.OWNER_ID = 'o';
 Space.Net.PACKET_ID = 'q';
 Space.Net.PING = 'p';
 Space.Net.PLAYER_ID = 'j';
 Space.Net.POSITION_X = 'x';
 Space.Net.POSITION_Y = 'y';
+Space.Net.REMOVED = 'r';
 Space.Net.TIMESTAMP = 's';
 Space.Net.VELOCITY_X = 'u';
 Space.Net.VELOCITY_Y = 'v';
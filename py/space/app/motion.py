@@ -0,0 +1,265 @@
+# -*- coding: cp1252 -*-
+#
+# Copyright (c) 2008 Andreas Blixt <andreas@blixt.org>
+#
+# Project location:
+# /svn/trunk/py/space/ @ <http://code.google.com/p/blixt/>
+#
+# License: MIT license <http://www.opensource.org/licenses/mit-license.php>
+#
+
+"""Equations of motion for the ships of the Space game.
+
+A ship turns at a constant rate and accelerates at a constant rate in the
+direction it is facing, with its speed clamped to a maximum. Instead of
+stepping through time, the motion is split into at most a few segments that
+are each solved in closed form:
+
+  * Unclamped: the velocity is a straight line (not turning) or a circle
+    (turning) in velocity space, until it reaches the maximum speed.
+  * Clamped: the speed stays at the maximum while the velocity is pulled
+    towards the facing direction, until the facing direction has turned away
+    far enough that the thrust starts slowing the ship down again.
+
+The only part without a closed form is the position while clamped and
+turning at the same time. That is integrated numerically, but only over the
+clamped segment, which has a bounded length, so the cost of advancing a ship
+does not grow with the time passed.
+"""
+
+import math
+
+TWO_PI = math.pi * 2
+
+# Tolerance used when comparing speeds and angles.
+EPSILON = 1e-9
+
+def advance(ship, dt):
+    """Advances the direction, velocity and position of a ship by dt
+    seconds, using the ship's move and turn modifiers and rate constants.
+
+    The position is not wrapped around the boundaries of the Universe.
+    """
+    omega = ship.TURN_RATE * ship.turn_mod
+    accel = ship.ACCELERATION_RATE * abs(ship.move_mod)
+    max_speed = ship.MAX_SPEED
+
+    # Decelerating is the same thing as accelerating backwards.
+    offset = math.pi if ship.move_mod < 0 else 0.0
+
+    theta = ship.direction + offset
+    vx, vy = ship.velocity_x, ship.velocity_y
+    px, py = ship.position_x, ship.position_y
+
+    if not accel:
+        px += vx * dt
+        py += vy * dt
+        theta += omega * dt
+    else:
+        # The step-wise model clamps the speed as soon as there is thrust.
+        speed = math.hypot(vx, vy)
+        if speed > max_speed:
+            vx *= max_speed / speed
+            vy *= max_speed / speed
+
+        # After leaving the maximum speed while turning, the velocity moves
+        # on a circle that only touches the maximum speed, so the ship can
+        # never be clamped again.
+        free = False
+
+        # There are at most three segments: unclamped, clamped and unclamped
+        # again.
+        for i in xrange(3):
+            if dt <= 0: break
+
+            if not free and _is_clamped(vx, vy, theta, max_speed):
+                span, free = _clamped(theta, vx, vy, omega, accel, max_speed,
+                                      dt)
+                theta, vx, vy, dx, dy = span[1:]
+            else:
+                span = _unclamped(theta, vx, vy, omega, accel, max_speed, dt,
+                                  free)
+                theta, vx, vy, dx, dy = span[1:]
+
+            px += dx
+            py += dy
+            dt -= span[0]
+
+    ship.direction = (theta - offset) % TWO_PI
+    ship.velocity_x, ship.velocity_y = vx, vy
+    ship.position_x, ship.position_y = px, py
+
+def _is_clamped(vx, vy, theta, max_speed):
+    """Returns True if the ship is at its maximum speed and the thrust has a
+    component pointing outwards, keeping it there.
+    """
+    if math.hypot(vx, vy) < max_speed * (1 - EPSILON):
+        return False
+    return vx * math.cos(theta) + vy * math.sin(theta) > EPSILON
+
+def _normalize(angle):
+    """Returns the angle in the range [-pi, pi)."""
+    return (angle + math.pi) % TWO_PI - math.pi
+
+def _unclamped(theta, vx, vy, omega, accel, max_speed, limit, free):
+    """Solves the motion of a ship below its maximum speed for at most limit
+    seconds.
+
+    Returns a (time, theta, velocity x, velocity y, delta x, delta y) tuple.
+    """
+    cos0, sin0 = math.cos(theta), math.sin(theta)
+
+    if not omega:
+        # Constant acceleration in a fixed direction.
+        if free:
+            t = limit
+        else:
+            b = accel * (vx * cos0 + vy * sin0)
+            c = vx * vx + vy * vy - max_speed * max_speed
+            a2 = accel * accel
+            t = min(limit, (-b + math.sqrt(max(b * b - a2 * c, 0))) / a2)
+
+        m = accel * t
+        return (t, theta, vx + cos0 * m, vy + sin0 * m,
+                (vx + cos0 * m / 2) * t, (vy + sin0 * m / 2) * t)
+
+    # The velocity moves on a circle with radius q around the center c.
+    q = accel / omega
+    cx, cy = vx - q * sin0, vy + q * cos0
+
+    t = limit
+    if not free:
+        # The speed reaches its maximum when
+        #   |c|^2 + q^2 + 2q * |c| * sin(theta - beta) = max_speed^2
+        # and it is crossed outwards where cos(theta - beta) > 0.
+        r = math.hypot(cx, cy)
+        k = (max_speed * max_speed - r * r - q * q) / (2 * q)
+        if r > 0 and abs(k) < r * (1 - EPSILON):
+            target = math.atan2(cy, cx) + math.asin(k / r)
+            if omega > 0:
+                t = ((target - theta) % TWO_PI) / omega
+            else:
+                t = ((theta - target) % TWO_PI) / -omega
+            t = min(limit, t)
+
+    theta1 = theta + omega * t
+    cos1, sin1 = math.cos(theta1), math.sin(theta1)
+    return (t, theta1, cx + q * sin1, cy - q * cos1,
+            cx * t + q / omega * (cos0 - cos1),
+            cy * t + q / omega * (sin0 - sin1))
+
+def _clamped(theta, vx, vy, omega, accel, max_speed, limit):
+    """Solves the motion of a ship at its maximum speed for at most limit
+    seconds.
+
+    The angle phi between the velocity and the thrust follows
+      dphi/dt = -(k * sin(phi) + omega), k = accel / max_speed
+    which is solved for phi in closed form through tan(phi / 2).
+
+    Returns a ((time, theta, velocity x, velocity y, delta x, delta y),
+    exited) tuple, where exited is True if the ship dropped below its maximum
+    speed at the end of the segment.
+    """
+    k = accel / max_speed
+    phi0 = _normalize(math.atan2(vy, vx) - theta)
+    phi0 = max(-math.pi / 2, min(math.pi / 2, phi0))
+    t0 = math.tan(phi0 / 2)
+
+    if not omega:
+        # The velocity turns towards the thrust and never leaves the maximum
+        # speed. The position has a closed form as well.
+        t = limit
+        tt = t0 * math.exp(-k * t)
+        phi = 2 * math.atan(tt)
+
+        along = max_speed * t + max_speed / k * math.log((1 + tt * tt) /
+                                                          (1 + t0 * t0))
+        across = max_speed / k * (phi0 - phi)
+
+        cos0, sin0 = math.cos(theta), math.sin(theta)
+        return ((t, theta,
+                 max_speed * math.cos(theta + phi),
+                 max_speed * math.sin(theta + phi),
+                 along * cos0 - across * sin0,
+                 along * sin0 + across * cos0), False)
+
+    # A turn rate exactly equal to k has no solution of either form below,
+    # so nudge it by a negligible amount.
+    if abs(abs(omega) - k) < EPSILON:
+        omega *= 1 + 2 * EPSILON
+
+    exited = False
+    if abs(omega) > k:
+        # The ship turns faster than its velocity can follow, so it will
+        # eventually leave the maximum speed when phi reaches -pi/2 (turning
+        # right) or pi/2 (turning left).
+        s = math.sqrt(omega * omega - k * k)
+        h = lambda tt: 2 / s * math.atan((omega * tt + k) / s)
+        h0 = h(t0)
+
+        phi_exit = -math.pi / 2 if omega > 0 else math.pi / 2
+        t_exit = h0 - h(math.tan(phi_exit / 2))
+        if t_exit <= limit:
+            exited = True
+            limit = t_exit
+
+        def phi_at(t):
+            return 2 * math.atan((s * math.tan((h0 - t) * s / 2) - k) / omega)
+
+        t = limit
+        quad_time = t
+    else:
+        # The velocity settles at a fixed angle behind the thrust and then
+        # keeps turning with it forever.
+        s = math.sqrt(k * k - omega * omega)
+        x0 = (omega * t0 + k - s) / (omega * t0 + k + s)
+
+        def phi_at(t):
+            x = x0 * math.exp(-s * t)
+            return 2 * math.atan((x * (k + s) - k + s) / (omega * (1 - x)))
+
+        t = limit
+        if x0:
+            quad_time = min(t, math.log(abs(x0) / EPSILON) / s)
+        else:
+            quad_time = 0.0
+
+    psi_at = lambda t: theta + omega * t + phi_at(t)
+    dx, dy = _integrate_heading(psi_at, quad_time, abs(omega) + k)
+
+    # Once settled, the velocity is a uniform rotation of the settled
+    # heading.
+    if quad_time < t:
+        psi0, psi1 = psi_at(quad_time), psi_at(t)
+        dx += (math.sin(psi1) - math.sin(psi0)) / omega
+        dy += (math.cos(psi0) - math.cos(psi1)) / omega
+
+    theta1 = theta + omega * t
+    psi1 = psi_at(t)
+    if exited:
+        # Avoid rounding errors deciding the next segment.
+        psi1 = theta1 + phi_exit
+
+    return ((t, theta1,
+             max_speed * math.cos(psi1), max_speed * math.sin(psi1),
+             max_speed * dx, max_speed * dy), exited)
+
+def _integrate_heading(psi_at, length, rate):
+    """Integrates the unit vector (cos psi, sin psi) from 0 to length using
+    Simpson's rule, with psi changing by at most rate radians per second.
+    """
+    if length <= 0:
+        return 0.0, 0.0
+
+    # Keep every panel within a small angle for accuracy.
+    n = max(8, 2 * int(math.ceil(length * rate / 0.1)))
+    h = length / n
+
+    sx = sy = 0.0
+    for i in xrange(n + 1):
+        psi = psi_at(i * h)
+        w = 1 if i == 0 or i == n else (4 if i % 2 else 2)
+        sx += w * math.cos(psi)
+        sy += w * math.sin(psi)
+
+    return sx * h / 3, sy * h / 3
@@ -0,0 +1,93 @@
+# -*- coding: cp1252 -*-
+#
+# Copyright (c) 2008 Andreas Blixt <andreas@blixt.org>
+#
+# Project location:
+# /svn/trunk/py/space/ @ <http://code.google.com/p/blixt/>
+#
+# License: MIT license <http://www.opensource.org/licenses/mit-license.php>
+#
+
+"""Keeps track of which clients are in the Space world.
+
+The clients of the world are changed one at a time: a client is added when it
+joins and removed when it leaves or its player has not sent anything for
+Player.TIMEOUT seconds. Every client also has a Client record in the
+datastore, and a cron job regularly compares the world with the records to
+clean up after anything that was missed, such as the world being evicted from
+memcache. Scanning the records takes time in proportion to the number of
+clients, so it's kept out of the requests of players.
+"""
+
+from google.appengine.ext import db
+
+import snapshot, space
+
+def leave(backend, world, auths):
+    """Removes clients from the world and deletes their records."""
+    if not auths:
+        return
+
+    for auth in auths:
+        world.clients.pop(auth, None)
+
+    snapshot.delete_histories(backend, auths)
+    db.delete([db.Key.from_path('Client', auth) for auth in auths])
+
+def expire(backend, world, now, keep=None):
+    """Removes the clients whose player timed out, except for the client with
+    the auth key keep.
+
+    Returns the auth keys of the removed clients.
+    """
+    expired = []
+    for auth, data in world.clients.iteritems():
+        if not data or auth == keep: continue
+
+        for entity in data[0].itervalues():
+            if (isinstance(entity, space.Player) and
+                now - entity.last_packet_time >= space.Player.TIMEOUT):
+                expired.append(auth)
+                break
+
+    leave(backend, world, expired)
+    return expired
+
+def records():
+    """Returns the auth keys of the client records in the datastore, as a
+    dictionary of sets by shard index.
+
+    The query isn't filtered by shard, since records saved before clients had
+    a shard have no shard property and would never match the filter. Those
+    records belong to shard 0.
+    """
+    shards = {}
+    for client in space.Client.all():
+        shards.setdefault(client.shard or 0, set()).add(client.key().name())
+    return shards
+
+def reconcile(backend, world, now, auths):
+    """Compares the clients of the world with the auth keys of the client
+    records of its shard, as returned by records.
+
+    Clients without a record are removed from the world. Records without a
+    client are deleted if they were also missing at the previous
+    reconciliation, since a client that is joining right now has a record
+    before it's saved to the world.
+
+    Returns the auth keys of the removed clients.
+    """
+    clients = set(world.clients)
+
+    gone = list(clients - auths)
+    for auth in gone:
+        del world.clients[auth]
+    snapshot.delete_histories(backend, gone)
+
+    orphans = auths - clients
+    stale = orphans & world.orphans
+    db.delete([db.Key.from_path('Client', auth) for auth in stale])
+
+    world.orphans = orphans - stale
+    world.reconciled = now
+    return gone
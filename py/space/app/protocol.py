@@ -0,0 +1,261 @@
+# -*- coding: cp1252 -*-
+#
+# Copyright (c) 2008 Andreas Blixt <andreas@blixt.org>
+#
+# Project location:
+# /svn/trunk/py/space/ @ <http://code.google.com/p/blixt/>
+#
+# License: MIT license <http://www.opensource.org/licenses/mit-license.php>
+#
+
+"""Wire formats for the world sent to clients of the Space game.
+
+The world is encoded from entity state tuples, as returned by get_state() of
+entities and entity stores:
+  (type, position x, position y, velocity x, velocity y, timestamp)
+Players add their direction and ping at the end of the tuple. Hits are sent
+along with the entities as events, from the collision.Hit objects of the last
+update. A client may get the same hit more than once, so it should tell them
+apart by projectile id.
+
+Two formats are supported. JSON is what the browser client understands. The
+binary format packs the same data with struct in network byte order:
+
+  Header:     version (B), flags (B), base time (d)
+  NEW_CLIENT: player id (I), auth key length (B), auth key
+  DELTA:      baseline (i), removed count (I), removed ids (I each)
+  WORLD:      world version (I)
+  HITS:       hit count (I), then for each hit:
+                projectile id (I), player id (I), owner id (i, -1 if not
+                known), time (f, seconds relative to the base time)
+  Entities:   entity count (I), then for each entity:
+                id (I), type (b), position x/y (H, quantized over the
+                Universe), velocity x/y (h, in 1/256 units per second),
+                timestamp (f, seconds relative to the base time)
+              and for players:
+                direction (H, quantized over a full turn), ping (H)
+
+The version byte is space.VERSION. A client asks for the binary format by
+sending the version it understands as the FORMAT parameter, and gets JSON if
+that version is not the one spoken by the server.
+"""
+
+import cStringIO as StringIO
+import math, struct
+
+import space
+
+NEW_CLIENT = 1
+DELTA = 2
+WORLD = 4
+HITS = 8
+
+VELOCITY_SCALE = 256.0
+
+_HEADER = struct.Struct('!BBd')
+_CLIENT = struct.Struct('!IB')
+_DELTA = struct.Struct('!iI')
+_WORLD = struct.Struct('!I')
+_HIT = struct.Struct('!IIif')
+_COUNT = struct.Struct('!I')
+_ENTITY = struct.Struct('!IbHHhhf')
+_PLAYER = struct.Struct('!HH')
+
+class Error(Exception):
+    pass
+
+class DecodeError(Error):
+    pass
+
+def state_json(state):
+    """Returns the JSON representation of an entity state tuple."""
+    if len(state) > 6:
+        f = '{"%s":%d,"%s":%f,"%s":%f,"%s":%f,"%s":%f,"%s":%f,"%s":%d,"%s":%f}'
+        return f % (
+            space.ENTITY_TYPE, state[0],
+            space.POSITION_X, state[1],
+            space.POSITION_Y, state[2],
+            space.VELOCITY_X, state[3],
+            space.VELOCITY_Y, state[4],
+            space.DIRECTION, state[6],
+            space.PING, state[7],
+            space.TIMESTAMP, state[5])
+
+    return '{"%s":%d,"%s":%f,"%s":%f,"%s":%f,"%s":%f,"%s":%f}' % (
+        space.ENTITY_TYPE, state[0],
+        space.POSITION_X, state[1],
+        space.POSITION_Y, state[2],
+        space.VELOCITY_X, state[3],
+        space.VELOCITY_Y, state[4],
+        space.TIMESTAMP, state[5])
+
+def hit_json(hit):
+    """Returns the JSON representation of a hit."""
+    owner_id = hit.owner_id
+    if owner_id is None: owner_id = -1
+    return '{"%s":%d,"%s":%d,"%s":%d,"%s":%f}' % (
+        space.ENTITY_ID, hit.projectile_id,
+        space.PLAYER_ID, hit.player_id,
+        space.OWNER_ID, owner_id,
+        space.TIMESTAMP, hit.time)
+
+def encode_json(states, client=None, removed=None, baseline=None,
+                world_version=None, hits=None):
+    """Encodes (id, state) pairs as JSON.
+
+    For new clients, client is a (player id, auth key) tuple. For deltas,
+    removed is a list of ids and baseline the snapshot the delta is relative
+    to. The world version is included when streaming the world. Hits is a
+    list of collision.Hit objects to report to the client.
+    """
+    buf = StringIO.StringIO()
+    buf.write('{')
+    if client:
+        buf.write('"%s":%d,"%s":"%s",' % (space.PLAYER_ID, client[0],
+                                          space.AUTH_KEY, client[1]))
+
+    buf.write('"%s":{' % space.ENTITY_DATA)
+    first = True
+    for ent_id, state in states:
+        if not first: buf.write(',')
+        buf.write('"%d":%s' % (ent_id, state_json(state)))
+        first = False
+    buf.write('}')
+
+    if baseline is not None:
+        buf.write(',"%s":[%s],"%s":%d' % (
+            space.REMOVED, ','.join([str(i) for i in removed]),
+            space.BASELINE, baseline))
+    if world_version is not None:
+        buf.write(',"%s":%d' % (space.WORLD_VERSION, world_version))
+    if hits:
+        buf.write(',"%s":[%s]' % (space.HITS,
+                                  ','.join([hit_json(hit) for hit in hits])))
+    buf.write('}')
+
+    data = buf.getvalue()
+    buf.close()
+    return data
+
+def _quantize(value, scale, low, high):
+    return max(low, min(high, int(round(value * scale))))
+
+def encode_binary(states, client=None, removed=None, baseline=None,
+                  world_version=None, hits=None):
+    """Encodes (id, state) pairs in the binary format. The arguments are the
+    same as for encode_json.
+    """
+    base = space.now or 0.0
+    scale_x = 65535.0 / space.DIMENSION_X
+    scale_y = 65535.0 / space.DIMENSION_Y
+    scale_d = 65536.0 / (math.pi * 2)
+
+    flags = 0
+    if client: flags |= NEW_CLIENT
+    if baseline is not None: flags |= DELTA
+    if world_version is not None: flags |= WORLD
+    if hits: flags |= HITS
+
+    parts = [_HEADER.pack(space.VERSION, flags, base)]
+    if client:
+        parts.append(_CLIENT.pack(client[0], len(client[1])))
+        parts.append(client[1])
+    if baseline is not None:
+        parts.append(_DELTA.pack(baseline, len(removed)))
+        parts.append(struct.pack('!%dI' % len(removed), *removed))
+    if world_version is not None:
+        parts.append(_WORLD.pack(world_version))
+    if hits:
+        parts.append(_COUNT.pack(len(hits)))
+        for hit in hits:
+            owner_id = hit.owner_id
+            if owner_id is None: owner_id = -1
+            parts.append(_HIT.pack(hit.projectile_id, hit.player_id, owner_id,
+                                   hit.time - base))
+
+    states = list(states)
+    parts.append(_COUNT.pack(len(states)))
+    for ent_id, state in states:
+        parts.append(_ENTITY.pack(
+            ent_id, state[0],
+            _quantize(state[1], scale_x, 0, 65535),
+            _quantize(state[2], scale_y, 0, 65535),
+            _quantize(state[3], VELOCITY_SCALE, -32768, 32767),
+            _quantize(state[4], VELOCITY_SCALE, -32768, 32767),
+            state[5] - base))
+        if len(state) > 6:
+            parts.append(_PLAYER.pack(
+                _quantize(state[6] % (math.pi * 2), scale_d, 0, 65536) % 65536,
+                _quantize(state[7], 1, 0, 65535)))
+
+    return ''.join(parts)
+
+def decode_binary(data):
+    """Decodes data in the binary format into a dictionary with the same keys
+    as the JSON format.
+    """
+    try:
+        version, flags, base = _HEADER.unpack_from(data)
+        if version != space.VERSION:
+            raise DecodeError('Unsupported version %d.' % version)
+        offset = _HEADER.size
+
+        result = {}
+        if flags & NEW_CLIENT:
+            player_id, length = _CLIENT.unpack_from(data, offset)
+            offset += _CLIENT.size
+            result[space.PLAYER_ID] = player_id
+            result[space.AUTH_KEY] = data[offset:offset + length]
+            offset += length
+
+        if flags & DELTA:
+            baseline, count = _DELTA.unpack_from(data, offset)
+            offset += _DELTA.size
+            result[space.BASELINE] = baseline
+            result[space.REMOVED] = list(struct.unpack_from('!%dI' % count,
+                                                            data, offset))
+            offset += count * 4
+
+        if flags & WORLD:
+            result[space.WORLD_VERSION], = _WORLD.unpack_from(data, offset)
+            offset += _WORLD.size
+
+        if flags & HITS:
+            count, = _COUNT.unpack_from(data, offset)
+            offset += _COUNT.size
+
+            hits = result[space.HITS] = []
+            for i in xrange(count):
+                proj_id, player_id, owner_id, t = _HIT.unpack_from(data,
+                                                                   offset)
+                offset += _HIT.size
+                hits.append({space.ENTITY_ID: proj_id,
+                             space.PLAYER_ID: player_id,
+                             space.OWNER_ID: owner_id,
+                             space.TIMESTAMP: base + t})
+
+        count, = _COUNT.unpack_from(data, offset)
+        offset += _COUNT.size
+
+        entities = result[space.ENTITY_DATA] = {}
+        for i in xrange(count):
+            ent_id, ent_type, x, y, u, v, t = _ENTITY.unpack_from(data, offset)
+            offset += _ENTITY.size
+
+            entity = entities[ent_id] = {
+                space.ENTITY_TYPE: ent_type,
+                space.POSITION_X: x * space.DIMENSION_X / 65535.0,
+                space.POSITION_Y: y * space.DIMENSION_Y / 65535.0,
+                space.VELOCITY_X: u / VELOCITY_SCALE,
+                space.VELOCITY_Y: v / VELOCITY_SCALE,
+                space.TIMESTAMP: base + t}
+
+            if ent_type == space.Player.TYPE:
+                d, ping = _PLAYER.unpack_from(data, offset)
+                offset += _PLAYER.size
+                entity[space.DIRECTION] = d * math.pi * 2 / 65536
+                entity[space.PING] = ping
+    except struct.error, e:
+        raise DecodeError(str(e))
+
+    return result
@@ -18,12 +18,62 @@ from google.appengine.api import urlfetch
 from google.appengine.ext import webapp
 import wsgiref.handlers
 
-import cStringIO as StringIO
 import time
 
-import space
+import presence, protocol, shard, snapshot, space, stats, tick
 
-class SpaceServer(webapp.RequestHandler):
+class WorldHandler(webapp.RequestHandler):
+    """Base class for handlers that send the world to clients."""
+
+    def send_world(self, auth, snapshot_id, states, client=None, stream=False,
+                   world_version=None, backend=None, hits=()):
+        """Sends (id, state) pairs to a client in the format it asked for.
+
+        Only what changed since the last snapshot the client applied is sent,
+        unless that snapshot is too old to still be in the history. The
+        history is kept in the backend of the shard of the client. Hits on
+        players the client can see are sent along with the entities.
+        """
+        backend = backend or space.world_backend
+        history = snapshot.load_history(backend, auth, stream)
+        stats.mark('history get')
+
+        baseline = self.request.get(space.BASELINE)
+        delta = None
+        if baseline:
+            baseline = int(baseline)
+            delta = history.delta(baseline, states)
+
+        history.add(snapshot_id, states)
+        stats.mark('delta')
+
+        if hits:
+            visible = set([ent_id for ent_id, state in states])
+            hits = [hit for hit in hits if hit.player_id in visible]
+        snapshot.save_history(backend, auth, history, stream)
+        stats.mark('history set')
+
+        # Serialize world to a string.
+        if self.request.get(space.FORMAT) == str(space.VERSION):
+            self.response.headers['Content-Type'] = 'application/octet-stream'
+            encode = protocol.encode_binary
+        else:
+            encode = protocol.encode_json
+
+        if delta:
+            data = encode(delta[0], client, delta[1], baseline, world_version,
+                          hits)
+        else:
+            data = encode(states, client, world_version=world_version,
+                          hits=hits)
+        stats.mark('encode')
+        stats.count('bytes', len(data))
+
+        # Send world to client.
+        self.response.out.write(data)
+        stats.mark('write')
+
+class SpaceServer(WorldHandler):
     time_offset = None
     
     def get(self):
@@ -34,35 +84,209 @@ class SpaceServer(webapp.RequestHandler):
         client_timestamp  = int(self.request.get(space.TIMESTAMP))
 
         space.now = time.time()
+        stats.begin('server')
+
+        router = shard.ShardRouter()
+        index = router.locate(auth)
+        backend = router.backend(index)
+        stats.mark('locate')
 
-        # Restore the session.
-        session = space.Session(auth)
-        if auth == session.auth:
-            session.player.handle_command(session, command, packet_id)
-            template = '{"%s":{%s}}'
+        published = None
+        if space.TICK_RATE:
+            engine = tick.TickEngine(backend, router=router, shard=index)
+            published = engine.latest()
+            stats.mark('published get')
+
+        if published and auth in published.players:
+            # The tick engine advances the world, so all that's left to do is
+            # to queue the command and send the last published world.
+            engine.queue(auth, command, packet_id, client_timestamp)
+            stats.mark('queue')
+            client = None
+            states = published.visible_states(auth, space.AREA_OF_INTEREST,
+                                              router.ghosts(index))
+            hits = published.hits
         else:
-            template = '{"%s":%d,"%s":"%s","%%s":{%%s}}' % (
-                space.PLAYER_ID, session.player.id,
-                space.AUTH_KEY, session.auth)
+            # Restore the session.
+            session = space.Session(auth, backend, index)
+            stats.mark('session')
+            if auth == session.auth:
+                session.player.handle_command(session, command, packet_id,
+                                              client_timestamp)
+                client = None
+            else:
+                client = (session.player.id, session.auth)
+                auth = session.auth
+            stats.mark('command')
 
-        # Update the session.
-        session.update()
+            # Update the session, and move it to another shard if the player
+            # left the region of this one. Ghosts are only added after the
+            # entities of this shard have been published as ghosts.
+            session.update()
+            router.publish_ghosts(index, session.iterstates())
+            session.ghosts = router.ghosts(index)
+            router.move(session)
+            states = list(session.iterstates(space.AREA_OF_INTEREST))
+            hits = session.hits
+        stats.mark('states')
+        stats.count('entities', len(states))
 
-        # Serialize world to a string.
-        buf = StringIO.StringIO()
-        for ent_id in session.entities:
-            ent = session.entities[ent_id]
-            if buf.tell() > 0: buf.write(',')
-            buf.write('"%d":%s' % (ent_id, ent.to_json()))
+        self.send_world(auth, packet_id, states, client, backend=backend,
+                        hits=hits)
+        stats.end()
+
+class StreamHandler(WorldHandler):
+    """Long-polls for the next world published by the tick engine.
+
+    Clients send the world version they last received (w) and get a response
+    as soon as a newer world is published, or an empty 204 response after
+    WAIT seconds. Snapshots are numbered by world version, so the baseline
+    (b) is the last world version the client applied. Commands are sent
+    separately to CommandHandler.
+
+    Clients must have joined through SpaceServer first, and the tick engine
+    has to be enabled. While waiting, the handler runs any ticks that are due,
+    so the world keeps moving as long as somebody is listening.
+    """
+
+    WAIT = 20
+
+    def get(self):
+        auth = self.request.get(space.AUTH_KEY)
+        version = int(self.request.get(space.WORLD_VERSION) or 0)
+
+        if not space.TICK_RATE:
+            self.error(501)
+            return
+
+        router = shard.ShardRouter()
+        index = router.locate(auth)
+        backend = router.backend(index)
+
+        engine = tick.TickEngine(backend, router=router, shard=index)
+        interval = 0.5 / space.TICK_RATE
+
+        # Waiting for the world counts as activity, so that clients that only
+        # listen don't time out. The heartbeat is queued at the current time.
+        space.now = time.time()
+        engine.queue(auth, space.REFRESH, None)
+        deadline = time.time() + self.WAIT
+        while engine.latest_version() <= version:
+            if time.time() >= deadline:
+                self.response.set_status(204)
+                return
+
+            engine.run_due()
+            time.sleep(interval)
+
+        space.now = time.time()
+
+        published = engine.latest()
+        if auth not in published.players:
+            self.error(403)
+            return
+
+        stats.begin('stream')
+        states = published.visible_states(auth, space.AREA_OF_INTEREST,
+                                          router.ghosts(index))
+        stats.mark('states')
+        stats.count('entities', len(states))
+
+        self.send_world(auth, published.version, states, stream=True,
+                        world_version=published.version, backend=backend,
+                        hits=published.hits)
+        stats.end()
+
+class CommandHandler(webapp.RequestHandler):
+    """Queues a command for the tick engine without sending anything back."""
+
+    def post(self):
+        if not space.TICK_RATE:
+            self.error(501)
+            return
+
+        space.now = time.time()
+        auth = self.request.get(space.AUTH_KEY)
+
+        router = shard.ShardRouter()
+        engine = tick.TickEngine(router.backend(router.locate(auth)))
+        timestamp = self.request.get(space.TIMESTAMP)
+        engine.queue(auth, int(self.request.get(space.COMMAND)),
+                     int(self.request.get(space.PACKET_ID)),
+                     timestamp and int(timestamp) or None)
+        self.response.set_status(204)
+
+class TickHandler(webapp.RequestHandler):
+    """Runs the ticks of the tick engine that are due. Request this URL
+    regularly when no dedicated process is running the engine.
+    """
+
+    def get(self):
+        self.response.headers['Content-Type'] = 'text/plain'
+        if not space.TICK_RATE:
+            self.response.out.write('disabled')
+            return
+
+        # The engines of all shards are run, and the number of ticks run by
+        # each is written on a line of its own.
+        router = shard.ShardRouter()
+        for index in xrange(router.count):
+            stats.begin('tick')
+            ticks = tick.TickEngine(router.backend(index), router=router,
+                                    shard=index).run_due()
+            stats.end()
+            self.response.out.write('busy' if ticks is None else str(ticks))
+            self.response.out.write('\n')
+
+class ReconcileHandler(webapp.RequestHandler):
+    """Compares the clients of the worlds of all shards with the client
+    records in the datastore. Requested by the cron job in cron.yaml, so that
+    the scan of the records doesn't slow down the requests of players.
+    """
+
+    def get(self):
+        self.response.headers['Content-Type'] = 'text/plain'
+        now = time.time()
+        records = presence.records()
+
+        # The number of clients removed from the world of each shard is
+        # written on a line of its own.
+        router = shard.ShardRouter()
+        for index in xrange(router.count):
+            backend = router.backend(index)
+            auths = records.get(index, set())
+            for i in xrange(space.Session.SAVE_RETRIES):
+                world = backend.load_world()
+                gone = presence.reconcile(backend, world, now, auths)
+                if backend.save_world(world): break
+            self.response.out.write(str(len(gone)))
+            self.response.out.write('\n')
+
+class StatsHandler(webapp.RequestHandler):
+    """Shows the request statistics gathered by the current process. Add
+    reset=1 to start over.
+    """
+
+    def get(self):
+        self.response.headers['Content-Type'] = 'text/plain'
+        if not stats.ENABLED:
+            self.response.out.write('disabled')
+            return
+
+        self.response.out.write(stats.summary())
+        if self.request.get('reset'):
+            stats.reset()
+
+application = webapp.WSGIApplication([
+    ('/server', SpaceServer),
+    ('/server/command', CommandHandler),
+    ('/server/stream', StreamHandler),
+    ('/tick', TickHandler),
+    ('/reconcile', ReconcileHandler),
+    ('/stats', StatsHandler)
+])
 
-        # Send world to client.
-        self.response.out.write(template % (space.ENTITY_DATA, buf.getvalue()))
-        buf.close()
-        
 def main():
-    application = webapp.WSGIApplication([
-        ('/server', SpaceServer)
-    ])
     wsgiref.handlers.CGIHandler().run(application)
 
 if __name__ == '__main__':
@@ -0,0 +1,210 @@
+# -*- coding: cp1252 -*-
+#
+# Copyright (c) 2008 Andreas Blixt <andreas@blixt.org>
+#
+# Project location:
+# /svn/trunk/py/space/ @ <http://code.google.com/p/blixt/>
+#
+# License: MIT license <http://www.opensource.org/licenses/mit-license.php>
+#
+
+"""Splitting the Space Universe into shards.
+
+The Universe is divided into a grid of regions, space.SHARDS columns by
+rows, and each region is a shard with a world of its own, stored under its
+own keys. A client belongs to the shard of the region its player is in, and
+is handed off to another shard when the player crosses into its region.
+
+Entities close to the border of a region are also published as ghosts,
+which the neighboring shards send to their clients along with their own
+entities, so that players can see across borders.
+
+With a single shard, the world is stored in space.world_backend just like
+before shards existed.
+"""
+
+import time
+
+import space
+
+# Entities this close to the border of their region are ghosted to the
+# neighboring regions.
+GHOST_MARGIN = 500
+
+# Ghosts that have not been published again in this many seconds are
+# ignored.
+GHOST_TTL = 5
+
+class ShardRouter(object):
+    """Assigns clients to shards and moves them between shards.
+
+    Usage:
+    >>> router = ShardRouter()
+    >>> shard = router.locate(auth)
+    >>> session = space.Session(auth, router.backend(shard), shard)
+    """
+
+    SAVE_RETRIES = 5
+
+    def __init__(self, columns=None, rows=None, root=None):
+        if columns is None:
+            columns, rows = space.SHARDS
+        self.columns = columns
+        self.rows = rows
+        self.count = columns * rows
+
+        self.root = root or space.world_backend
+        self.width = float(space.DIMENSION_X) / columns
+        self.height = float(space.DIMENSION_Y) / rows
+
+        self.backends = {}
+
+    def backend(self, shard):
+        """Returns the backend that stores the world of a shard."""
+        if self.count == 1:
+            return self.root
+
+        if shard not in self.backends:
+            self.backends[shard] = self.root.shard(shard)
+        return self.backends[shard]
+
+    def region(self, x, y):
+        """Returns the shard of the region containing a point."""
+        col = int(x // self.width) % self.columns
+        row = int(y // self.height) % self.rows
+        return row * self.columns + col
+
+    def neighbors(self, shard):
+        """Returns the shards of the regions around a region, which wrap
+        around the boundaries of the Universe just like entities do.
+        """
+        row, col = divmod(shard, self.columns)
+        result = set()
+        for dr in (-1, 0, 1):
+            for dc in (-1, 0, 1):
+                result.add(((row + dr) % self.rows) * self.columns +
+                           (col + dc) % self.columns)
+        result.discard(shard)
+        return list(result)
+
+    def spawn(self):
+        """Returns the shard that new players start in."""
+        return self.region(space.Player.SPAWN_X, space.Player.SPAWN_Y)
+
+    def locate(self, auth):
+        """Returns the shard a client belongs to, or the shard new players
+        start in if the client is unknown.
+        """
+        if self.count == 1:
+            return 0
+        if not auth:
+            return self.spawn()
+
+        shard = self.root.get('shard_' + auth)
+        if shard is None:
+            client = space.Client.get_by_key_name(auth)
+            if not client:
+                return self.spawn()
+
+            shard = client.shard
+            self.root.set('shard_' + auth, shard)
+        return shard
+
+    def handoff(self, auth, data, target):
+        """Moves the data of a client to the world of another shard. The
+        caller removes the client from the world it was in.
+
+        Returns False if the world of the target shard couldn't be saved.
+        """
+        # The record is changed first, so that reconciliation in the target
+        # shard never sees the client without a record.
+        client = space.Client.get_by_key_name(auth)
+        if client:
+            client.shard = target
+            client.put()
+
+        backend = self.backend(target)
+        for i in xrange(self.SAVE_RETRIES):
+            world = backend.load_world()
+            world.clients[auth] = data
+            if backend.save_world(world): break
+        else:
+            return False
+
+        self.root.set('shard_' + auth, target)
+        return True
+
+    def rebalance(self, world, shard):
+        """Hands off the clients in a world whose player has left the region
+        of the shard, removing them from the world.
+
+        Returns the auth keys of the clients that were handed off.
+        """
+        moved = []
+        for auth, data in world.clients.items():
+            if not data: continue
+
+            for entity in data[0].itervalues():
+                if isinstance(entity, space.Player):
+                    target = self.region(entity.position_x,
+                                         entity.position_y)
+                    if target != shard and self.handoff(auth, data, target):
+                        del world.clients[auth]
+                        moved.append(auth)
+                    break
+        return moved
+
+    def move(self, session):
+        """Hands off the client of a session if its player has left the
+        region of the session's shard.
+
+        Returns the shard the client belongs to afterwards.
+        """
+        p = session.player
+        target = self.region(p.position_x, p.position_y)
+        if target == session.shard:
+            return target
+
+        if not self.handoff(session.auth, (session.data, session.store),
+                            target):
+            return session.shard
+
+        for i in xrange(self.SAVE_RETRIES):
+            session.world.clients.pop(session.auth, None)
+            if session.backend.save_world(session.world): break
+            session.world = session.backend.load_world()
+        return target
+
+    def is_border(self, x, y):
+        """Returns True if a point is close to the border of its region."""
+        dx = x % self.width
+        dy = y % self.height
+        if self.columns > 1 and min(dx, self.width - dx) < GHOST_MARGIN:
+            return True
+        return self.rows > 1 and min(dy, self.height - dy) < GHOST_MARGIN
+
+    def publish_ghosts(self, shard, states):
+        """Publishes the (id, state) pairs of the entities close to the
+        border of a shard for its neighbors to see.
+        """
+        if self.count == 1:
+            return
+
+        ghosts = [(ent_id, state) for ent_id, state in states
+                  if self.is_border(state[1], state[2])]
+        self.backend(shard).set('ghosts', (time.time(), ghosts))
+
+    def ghosts(self, shard):
+        """Returns the (id, state) pairs published as ghosts by the neighbors
+        of a shard.
+        """
+        if self.count == 1:
+            return []
+
+        result = []
+        now = time.time()
+        for neighbor in self.neighbors(shard):
+            published = self.backend(neighbor).get('ghosts')
+            if published and now - published[0] < GHOST_TTL:
+                result.extend(published[1])
+        return result
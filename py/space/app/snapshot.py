@@ -0,0 +1,116 @@
+# -*- coding: cp1252 -*-
+#
+# Copyright (c) 2008 Andreas Blixt <andreas@blixt.org>
+#
+# Project location:
+# /svn/trunk/py/space/ @ <http://code.google.com/p/blixt/>
+#
+# License: MIT license <http://www.opensource.org/licenses/mit-license.php>
+#
+
+"""Snapshot history for delta encoding the world sent to a client.
+
+Every response to a client is a snapshot of the world, identified by the
+packet id of the request it answered. The client acknowledges the last
+snapshot it applied, and the next response only has to contain what changed
+since then.
+
+Clients move entities on their own between snapshots, so an entity only
+counts as changed when its trajectory changes, not every time it is
+refreshed.
+"""
+
+import space
+
+# Positions are compared rounded to this many units, so that the rounding
+# errors of refreshing an entity don't count as a change.
+PRECISION = 0.01
+
+def trajectory_hash(state):
+    """Returns a hash of the parts of an entity state that a client can't
+    extrapolate from an earlier state of the same entity: the type, the
+    velocity, the position projected back to time zero, and for players the
+    direction and ping.
+    """
+    t = state[5]
+    x = (state[1] - state[3] * t) % space.DIMENSION_X
+    y = (state[2] - state[4] * t) % space.DIMENSION_Y
+    return hash((state[0], state[3], state[4], round(x / PRECISION),
+                 round(y / PRECISION)) + state[6:])
+
+class SnapshotHistory(object):
+    """A ring buffer of the most recent snapshots sent to a client.
+
+    A snapshot is stored as a dictionary mapping entity ids to a hash of the
+    entity trajectory, which is enough to tell whether an entity changed.
+
+    Usage:
+    >>> history = SnapshotHistory()
+    >>> changed, removed = history.delta(baseline, states)
+    >>> history.add(packet_id, states)
+    """
+
+    SIZE = 16
+
+    def __init__(self, size=None):
+        self.size = size or self.SIZE
+        self.snapshots = []
+
+    def __contains__(self, snapshot_id):
+        return snapshot_id in [i for i, hashes in self.snapshots]
+
+    def __len__(self):
+        return len(self.snapshots)
+
+    def add(self, snapshot_id, states):
+        """Records the (id, state) pairs that were sent as a snapshot,
+        dropping the oldest snapshot if the buffer is full.
+        """
+        hashes = dict((ent_id, trajectory_hash(state))
+                      for ent_id, state in states)
+        self.snapshots.append((snapshot_id, hashes))
+        del self.snapshots[:-self.size]
+
+    def delta(self, baseline, states):
+        """Returns a (changed, removed) tuple relative to the baseline
+        snapshot, where changed is a list of the (id, state) pairs that were
+        created or changed and removed is a list of ids that no longer exist.
+
+        Returns None if the baseline is no longer in the history, in which
+        case the full state has to be sent.
+        """
+        for i, (snapshot_id, base) in enumerate(self.snapshots):
+            if snapshot_id == baseline: break
+        else:
+            return None
+
+        changed = [(ent_id, state) for ent_id, state in states
+                   if base.get(ent_id) != trajectory_hash(state)]
+
+        # Entities that were created after the baseline and have already been
+        # removed again may have reached the client through a snapshot newer
+        # than the baseline, so everything seen since the baseline counts.
+        current = set(ent_id for ent_id, state in states)
+        seen = set()
+        for snapshot_id, hashes in self.snapshots[i:]:
+            seen.update(hashes)
+        removed = list(seen - current)
+
+        return changed, removed
+
+def _history_key(auth, stream):
+    # Snapshots sent over the stream are numbered by world version instead of
+    # packet id, so they are kept in a history of their own.
+    return (stream and 'history_stream_' or 'history_') + auth
+
+def load_history(backend, auth, stream=False):
+    """Returns the history of snapshots sent to a client."""
+    return backend.get(_history_key(auth, stream)) or SnapshotHistory()
+
+def save_history(backend, auth, history, stream=False):
+    backend.set(_history_key(auth, stream), history)
+
+def delete_histories(backend, auths):
+    """Deletes the snapshot histories of clients that are gone."""
+    backend.delete_multi(auths, key_prefix='history_')
+    backend.delete_multi(auths, key_prefix='history_stream_')
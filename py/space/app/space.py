@@ -8,30 +8,51 @@
 # License: MIT license <http://www.opensource.org/licenses/mit-license.php>
 #
 
-from google.appengine.api import memcache
 from google.appengine.ext import db
-import logging, math, uuid
+import itertools, logging, math, struct, uuid
+
+from backend import MemcacheBackend
+from store import EntityStore
+import collision, grid, inputs, presence, protocol, stats
 
 # The boundaries of the Universe!
 DIMENSION_X = 5000
 DIMENSION_Y = 5000
 
-VERSION = 2
+# The number of times per second the tick engine advances the world. Set to
+# None to advance the world as requests arrive instead.
+TICK_RATE = None
+
+# Only entities within this distance of their player are sent to clients. Set
+# to None to send the whole Universe.
+AREA_OF_INTEREST = None
+
+# The number of columns and rows of regions the Universe is split into. Each
+# region is a shard with a world of its own (see the shard module).
+SHARDS = (1, 1)
+
+VERSION = 3
 
 AUTH_KEY = 'a'
+BASELINE = 'b'
 COMMAND = 'c'
 DIRECTION = 'd'
 ENTITY_DATA = 'e'
+FORMAT = 'f'
+HITS = 'h'
 ENTITY_ID = 'i'
 ENTITY_TYPE = 't'
+OWNER_ID = 'o'
 PACKET_ID = 'q'
 PING = 'p'
 PLAYER_ID = 'j'
 POSITION_X = 'x'
 POSITION_Y = 'y'
+REMOVED = 'r'
 TIMESTAMP = 's'
 VELOCITY_X = 'u'
 VELOCITY_Y = 'v'
+WORLD_VERSION = 'w'
 
 REFRESH = 0
 PONG = 1
@@ -46,6 +67,31 @@ PING_REQUEST = 9
 
 now = None
 
+# Where the state of the world is stored.
+world_backend = MemcacheBackend()
+
+def refresh_client(data, store):
+    """Refreshes the entities of a client to the current time.
+
+    Projectiles only ever move in a straight line, so new projectiles are
+    moved out of the data dictionary and into the store, which refreshes them
+    in bulk and removes them when they expire. Returns the ids of the moved
+    projectiles.
+    """
+    moved = []
+    for i in data.keys():
+        entity = data[i]
+        if isinstance(entity, Projectile):
+            del data[i]
+            store.add(entity)
+            moved.append(i)
+        else:
+            entity.refresh()
+
+    store.expire(now)
+    store.refresh_all(now)
+    return moved
+
 class Error(Exception):
     pass
 
@@ -59,9 +105,12 @@ class StaticClassError(Error):
     pass
 
 class Client(db.Model):
+    # The shard whose world has the data of the client.
+    shard = db.IntegerProperty(default=0)
+
     @staticmethod
-    def create():
-        client = Client(key_name=uuid.uuid4().get_hex())
+    def create(shard=0):
+        client = Client(key_name=uuid.uuid4().get_hex(), shard=shard)
         client.save()
 
         return client
@@ -71,18 +120,47 @@ class Client(db.Model):
         client = Client.get_by_key_name(auth)
         if client: client.delete()
 
+def unpack_entity(data, *extra):
+    """Recreates an entity from the data returned by its pack method. This is
+    what entities are unpickled with.
+    """
+    cls = ENTITY_CLASSES[ord(data[0])]
+    entity = cls.__new__(cls)
+    entity.unpack(data, *extra)
+    return entity
+
+def _slots(cls):
+    """Returns the names of the slots of a class and its base classes."""
+    names = []
+    for c in cls.__mro__:
+        names.extend(c.__dict__.get('__slots__', ()))
+    return names
+
 class Entity(object):
+    """Base class of the entities in the world.
+
+    Entities have slots instead of a dictionary, and are pickled as a string
+    of packed values starting with the type of the entity, which is a lot
+    smaller than the default pickle of an object.
+    """
+
+    __slots__ = ('id', 'position_x', 'position_y', 'velocity_x', 'velocity_y',
+                 'last_refresh')
+
     TYPE = -1
 
+    # Type, id, position x/y, velocity x/y and time of last refresh.
+    PACKED = struct.Struct('!Bq5d')
+
     @staticmethod
-    def get_next_id():
-        return memcache.incr('next_id', initial_value=1)
+    def get_next_id(backend):
+        return backend.ids.next_id()
 
     def __init__(self, session):
         if not session.auth:
             raise NotAuthenticatedError('Must authenticate first.')
         
-        self.id = Entity.get_next_id()
+        self.id = self.new_id(session)
         self.position_x = 0.0
         self.position_y = 0.0
         self.velocity_x = 0.0
@@ -93,36 +171,55 @@ class Entity(object):
         session.data[self.id] = self
         session.entities[self.id] = self
 
+    def new_id(self, session):
+        return Entity.get_next_id(session.backend)
+
     def refresh(self):
         dt = now - self.last_refresh
 
         # Move the entity and make it wrap around boundaries.
-        # TODO: Handle extreme cases where entity has moved double the
-        #       boundary length.
-        self.position_x += self.velocity_x * dt
-        if self.position_x < 0:
-            self.position_x += DIMENSION_X
-        elif self.position_x > DIMENSION_X:
-            self.position_x -= DIMENSION_X
-
-        self.position_y += self.velocity_y * dt
-        if self.position_y < 0:
-            self.position_y += DIMENSION_Y
-        elif self.position_y > DIMENSION_Y:
-            self.position_y -= DIMENSION_Y
-        
+        self.position_x = (self.position_x + self.velocity_x * dt) % DIMENSION_X
+        self.position_y = (self.position_y + self.velocity_y * dt) % DIMENSION_Y
+
         self.last_refresh = now
 
+    def get_state(self):
+        """Returns the state of the entity as a tuple, in the format used by
+        the protocol module.
+        """
+        return (self.TYPE, self.position_x, self.position_y,
+                self.velocity_x, self.velocity_y, self.last_refresh)
+
     def to_json(self):
-        return '{"%s":%d,"%s":%f,"%s":%f,"%s":%f,"%s":%f,"%s":%f}' % (
-            ENTITY_TYPE, self.TYPE,
-            POSITION_X, self.position_x,
-            POSITION_Y, self.position_y,
-            VELOCITY_X, self.velocity_x,
-            VELOCITY_Y, self.velocity_y,
-            TIMESTAMP, self.last_refresh)
+        return protocol.state_json(self.get_state())
+
+    def __reduce__(self):
+        return unpack_entity, (self.pack(),)
+
+    def __setstate__(self, state):
+        # Entities pickled before they had slots are unpickled with a
+        # dictionary of their attributes.
+        names = _slots(self.__class__)
+        for name, value in state.iteritems():
+            if name in names: setattr(self, name, value)
+
+    def pack(self):
+        """Returns the attributes of the entity packed into a string."""
+        return Entity.PACKED.pack(
+            self.TYPE, self.id, self.position_x, self.position_y,
+            self.velocity_x, self.velocity_y, self.last_refresh)
+
+    def unpack(self, data):
+        """Sets the attributes of the entity from a string returned by
+        pack.
+        """
+        (t, self.id, self.position_x, self.position_y, self.velocity_x,
+         self.velocity_y, self.last_refresh) = Entity.PACKED.unpack_from(data)
 
 class Player(Entity):
+    __slots__ = ('direction', 'move_mod', 'turn_mod', 'last_packet_id',
+                 'last_packet_time', 'ping', 'ping_time', 'clock', 'inputs')
+
     TYPE = 0
 
     ACCELERATION_RATE = 15.0
@@ -130,13 +227,25 @@ class Player(Entity):
     MAX_SPEED = 40.0
     TIMEOUT = 10.0
 
+    # Where new players start.
+    SPAWN_X = 500.0
+    SPAWN_Y = 300.0
+
+    # The radius of the ship, used for hit detection.
+    RADIUS = 20.0
+
+    # Direction, move and turn modifiers, last packet id (-1 for none), time
+    # of last packet, ping, ping time (-1 for none), and clock offset and
+    # samples.
+    PACKED = struct.Struct('!dbbqddddI')
+
     def __init__(self, session):
         super(Player, self).__init__(session)
 
         self.direction = 0.0
 
-        self.position_x = 500.0
-        self.position_y = 300.0
+        self.position_x = self.SPAWN_X
+        self.position_y = self.SPAWN_Y
 
         self.move_mod = 0
         self.turn_mod = 0
@@ -147,10 +256,48 @@ class Player(Entity):
         self.ping = 0
         self.ping_time = None
 
-    def handle_command(self, session, cmd, packet_id):
+        self.clock = inputs.ClockOffset()
+        self.inputs = inputs.InputBuffer(self)
+
+    def handle_command(self, session, cmd, packet_id, timestamp=None):
+        """Handles a command from the client of the player. The timestamp is
+        the time in milliseconds on the clock of the client that the command
+        was sent at, if known.
+        """
         if cmd == PONG:
-            self.ping = (now - self.ping_time) * 1000
-        elif cmd == ACCELERATE:
+            if self.ping_time is not None:
+                round_trip = now - self.ping_time
+                self.ping = round_trip * 1000
+                if timestamp is not None:
+                    self.clock.add(timestamp / 1000.0, now, round_trip)
+        elif ACCELERATE <= cmd <= TURN_STOP:
+            self.inputs.apply(self, cmd, self.command_time(timestamp), now)
+        elif cmd == SHOOT:
+            self.shoot(session, self.command_time(timestamp))
+        elif cmd == PING_REQUEST:
+            self.ping_time = now
+
+        # Heartbeats queued by the server have no packet id, so they keep the
+        # id of the last packet the client sent.
+        if packet_id is not None:
+            self.last_packet_id = packet_id
+        self.last_packet_time = now
+
+    def command_time(self, timestamp):
+        """Returns the server time a command with a client timestamp was
+        sent at, or the current time if that can't be known.
+        """
+        if timestamp is None:
+            return now
+
+        t = self.clock.to_server(timestamp / 1000.0)
+        if t is None:
+            return now
+        return min(t, now)
+
+    def apply_input(self, cmd):
+        """Changes how the player moves according to a movement command."""
+        if cmd == ACCELERATE:
             self.move_mod = 1
         elif cmd == DECELERATE:
             self.move_mod = -1
@@ -162,167 +309,255 @@ class Player(Entity):
             self.turn_mod = 1
         elif cmd == TURN_STOP:
             self.turn_mod = 0
-        elif cmd == SHOOT:
-            self.shoot(session)
-        elif cmd == PING_REQUEST:
-            self.ping_time = now
-
-        self.last_packet_id = packet_id
-        self.last_packet_time = now
 
     def refresh(self):
-        #if now - self.last_packet_time >= self.TIMEOUT:
-        #    self.destroy()
-        #    return
+        # Players that time out are removed from the world by
+        # presence.expire.
+
+        # The motion is solved in closed form, so the cost of a refresh does
+        # not depend on how long ago the last one was.
+        inputs.advance(self, now)
+
+    def shoot(self, session, t=None):
+        """Fires a projectile from where the player was at the time t."""
+        # Expired projectiles don't count, and their ids can be reused.
+        session.store.expire(now)
+
+        count = len(session.store)
+        for entity in session.data.itervalues():
+            if isinstance(entity, Projectile): count += 1
+        if count >= Projectile.MAX_COUNT:
+            return
 
-        dt = now - self.last_refresh
+        origin = None
+        if t is not None and t < now:
+            m = self.inputs.motion_at(self, t, now)
+            origin = (m[-1], m[0], m[1], m[4])
 
-        # If the entity was already updated within a tenth of a second, don't
-        # bother updating...
-        if dt < 0.1:
-            return
+        proj = Projectile(session, origin)
 
-        # When acceleration or turning is involved, the entity will be updated
-        # step-wise.
-        # TODO: The "accelerating but not turning" case can easily be handled
-        #       using a formula.
-        if self.move_mod or self.turn_mod:
-            times = dt // 0.1
-            dt /= times
-        # Don't allow huge time steps either as they can mess with boundaries.
-        elif dt > 1:
-            times = dt // 1
-            dt /= times
-        else:
-            times = 1
-
-        for i in xrange(times):
-            if self.turn_mod:
-                self.direction = (self.direction + self.TURN_RATE *
-                                  self.turn_mod * dt) % (math.pi * 2)
-
-            if self.move_mod:
-                m = self.ACCELERATION_RATE * self.move_mod * dt
-                self.velocity_x += math.cos(self.direction) * m
-                self.velocity_y += math.sin(self.direction) * m
-
-                # TODO: Investigate more efficient methods.
-                spd = math.sqrt(self.velocity_x ** 2 + self.velocity_y ** 2)
-                if spd > self.MAX_SPEED:
-                    d = self.MAX_SPEED / spd
-                    self.velocity_x *= d
-                    self.velocity_y *= d
-
-            # Move the entity and make it wrap around boundaries.
-            # TODO: Handle extreme cases where entity has moved double the
-            #       boundary length.
-            self.position_x += self.velocity_x * dt
-            if self.position_x < 0:
-                self.position_x += DIMENSION_X
-            elif self.position_x > DIMENSION_X:
-                self.position_x -= DIMENSION_X
-
-            self.position_y += self.velocity_y * dt
-            if self.position_y < 0:
-                self.position_y += DIMENSION_Y
-            elif self.position_y > DIMENSION_Y:
-                self.position_y -= DIMENSION_Y
-        
-        self.last_refresh = now
+    def get_state(self):
+        return super(Player, self).get_state() + (self.direction, self.ping)
 
-    def shoot(self, session):
-        proj = Projectile(session)
+    def __reduce__(self):
+        return unpack_entity, (self.pack(), self.inputs)
 
-    def to_json(self):
-        f = '{"%s":%d,"%s":%f,"%s":%f,"%s":%f,"%s":%f,"%s":%f,"%s":%d,"%s":%f}'
-        return f % (
-            ENTITY_TYPE, self.TYPE,
-            POSITION_X, self.position_x,
-            POSITION_Y, self.position_y,
-            VELOCITY_X, self.velocity_x,
-            VELOCITY_Y, self.velocity_y,
-            DIRECTION, self.direction,
-            PING, self.ping,
-            TIMESTAMP, self.last_refresh)
+    def __setstate__(self, state):
+        Entity.__setstate__(self, state)
+        # Players saved before commands were buffered don't have these.
+        if 'clock' not in state:
+            self.clock = inputs.ClockOffset()
+        if 'inputs' not in state:
+            self.inputs = inputs.InputBuffer(self)
+
+    def pack(self):
+        clock = self.clock
+        return Entity.pack(self) + Player.PACKED.pack(
+            self.direction, self.move_mod, self.turn_mod,
+            (self.last_packet_id is None) and -1 or self.last_packet_id,
+            self.last_packet_time, self.ping,
+            (self.ping_time is None) and -1.0 or self.ping_time,
+            clock.offset or 0.0, clock.samples)
+
+    def unpack(self, data, buffer=None):
+        Entity.unpack(self, data)
+
+        clock = self.clock = inputs.ClockOffset()
+        (self.direction, self.move_mod, self.turn_mod, self.last_packet_id,
+         self.last_packet_time, self.ping, self.ping_time, clock.offset,
+         clock.samples) = Player.PACKED.unpack_from(data, Entity.PACKED.size)
+
+        if self.last_packet_id == -1: self.last_packet_id = None
+        if self.ping_time == -1.0: self.ping_time = None
+        if not clock.samples: clock.offset = None
+
+        self.inputs = buffer or inputs.InputBuffer(self)
 
 class Projectile(Entity):
+    __slots__ = ('expires', 'owner_id')
+
     TYPE = 1
     SPEED = 75.0
 
-    def __init__(self, session):
+    # The number of seconds a projectile exists, and the most projectiles a
+    # player can have at once.
+    TTL = 10.0
+    MAX_COUNT = 20
+
+    RADIUS = 2.0
+
+    # Expiry time and id of the player that fired the projectile.
+    PACKED = struct.Struct('!dq')
+
+    def __init__(self, session, origin=None):
+        """Creates a projectile fired by the player of the session. The
+        origin is a (time, position x, position y, direction) tuple if the
+        projectile was fired earlier than now.
+        """
         super(Projectile, self).__init__(session)
 
-        p = self.player = session.player
+        p = session.player
+        self.owner_id = p.id
+        if origin is None:
+            origin = (now, p.position_x, p.position_y, p.direction)
+        t, self.position_x, self.position_y, direction = origin
 
-        self.position_x = p.position_x
-        self.position_y = p.position_y
+        self.velocity_x = math.cos(direction) * self.SPEED
+        self.velocity_y = math.sin(direction) * self.SPEED
 
-        self.velocity_x = math.cos(p.direction) * self.SPEED
-        self.velocity_y = math.sin(p.direction) * self.SPEED
+        self.last_refresh = t
+        self.expires = t + self.TTL
 
-class Session(object):
-    @staticmethod
-    def refresh_clients():
-        """Updates the client list in memcache."""
-        clients = Client.all(keys_only=True)
+    def new_id(self, session):
+        # Reuse the id of an expired projectile of the same client before
+        # taking a new one.
+        return session.store.take_id() or Entity.get_next_id(session.backend)
 
-        new_keys = set([c.name() for c in clients])
-        old_keys = set(memcache.get('clients') or [])
+    def __setstate__(self, state):
+        Entity.__setstate__(self, state)
+        if 'expires' not in state:
+            self.expires = self.last_refresh + self.TTL
+        self.owner_id = state['player'].id
 
-        rem = old_keys - new_keys
-        add = new_keys - old_keys
+    def pack(self):
+        return Entity.pack(self) + Projectile.PACKED.pack(self.expires,
+                                                          self.owner_id)
 
-        memcache.set('clients', new_keys)
-        memcache.delete_multi(rem, key_prefix='client_')
-        memcache.add_multi(dict.fromkeys(add), key_prefix='client_')
+    def unpack(self, data):
+        Entity.unpack(self, data)
+        self.expires, self.owner_id = Projectile.PACKED.unpack_from(
+            data, Entity.PACKED.size)
 
-    def __init__(self, auth=None):
+# The entity classes by type, for unpacking.
+ENTITY_CLASSES = {Player.TYPE: Player, Projectile.TYPE: Projectile}
+
+class Session(object):
+    # The number of times to retry saving the world when another request saved
+    # it first.
+    SAVE_RETRIES = 5
+
+    def __init__(self, auth=None, backend=None, shard=0):
         self.auth = None
+        self.backend = backend or world_backend
+        self.shard = shard
         self.data = None
         self.entities = {}
         self.player = None
+        self.store = None
+        self.stores = []
+
+        # The projectiles that hit a player during the last update.
+        self.hits = []
+
+        # States of entities near the borders of neighboring shards.
+        self.ghosts = []
 
-        # Get a list of all clients from memcache, then fetch the clients.
-        clients = memcache.get('clients')
-        if clients:
-            # Get data for all clients.
-            data = memcache.get_multi(clients, key_prefix='client_')
-
-            # The keys are actually auth keys, so if the auth key sent by client
-            # matches, that key will represent the client data in memcache.
-            if auth in data:
-                self.auth = auth
-                self.data = data[auth] or {}
-
-                # Find the player entity.
-                for i in self.data:
-                    entity = self.data[i]
-                    if isinstance(entity, Player):
-                        self.player = entity
-                        break
-
-            # Build entities dictionary.
-            for key in data:
-                if data[key]: self.entities.update(data[key])
+        # A spatial grid of the states of the entities in the session, built
+        # the first time the entities near the player are needed.
+        self._grid = None
+
+        # The world holds the data of all clients. The data of a client is a
+        # dictionary of entity objects and a store of the client's
+        # projectiles.
+        self.world = self.backend.load_world()
+        data = self.world.clients
+
+        # The keys are actually auth keys, so if the auth key sent by client
+        # matches, that key will represent the client data in the world.
+        if auth in data:
+            self.auth = auth
+            self.data, self.store = data[auth] or ({}, EntityStore())
+
+            # Find the player entity.
+            for i in self.data:
+                entity = self.data[i]
+                if isinstance(entity, Player):
+                    self.player = entity
+                    break
+
+        # Build entities dictionary and list of stores.
+        for key in data:
+            if key == self.auth or not data[key]: continue
+            self.entities.update(data[key][0])
+            self.stores.append(data[key][1])
+
+            # Clients that don't send requests don't refresh their own
+            # projectiles, so expire them here.
+            data[key][1].expire(now)
 
         # Current session has not been authenticated, create a client.
         # TODO: This should be separate from session creation to allow
         #       spectators.
         if not self.auth:
-            client = Client.create()
-            Session.refresh_clients()
+            client = Client.create(shard)
 
             self.auth = client.key().name()
             self.data = {}
+            self.store = EntityStore()
 
             self.player = Player(self)
 
+        self.entities.update(self.data)
+        self.stores.append(self.store)
+
+    def iterstates(self, radius=None):
+        """Yields an (id, state) pair for every entity in the session, or only
+        for the entities within radius of the player if a radius is given.
+        """
+        if radius is not None:
+            if self._grid is None:
+                self._grid = grid.StateGrid(self._iterstates())
+
+            p = self.player
+            return iter(self._grid.within(p.position_x, p.position_y, radius,
+                                          self.ghosts))
+        return itertools.chain(self._iterstates(), self.ghosts)
+
+    def _iterstates(self):
+        for ent_id, entity in self.entities.iteritems():
+            yield ent_id, entity.get_state()
+
+        for store in self.stores:
+            for ent_id in store.ids:
+                yield ent_id, store.get_state(ent_id)
+
     def kill(self):
-        Client.kill(self.auth)
-        Session.refresh_clients()
+        for i in xrange(self.SAVE_RETRIES):
+            presence.leave(self.backend, self.world, [self.auth])
+            if self.backend.save_world(self.world): break
+            self.world = self.backend.load_world()
 
     def update(self):
         if self.auth:
-            for i in self.data:
-                self.data[i].refresh()
-            memcache.set('client_' + self.auth, self.data)
+            # Projectiles of all clients are checked, since clients that don't
+            # send requests would never check their own.
+            clients = [data for key, data in self.world.clients.iteritems()
+                       if data and key != self.auth]
+            clients.append((self.data, self.store))
+            self.hits = collision.collide(clients, now)
+            stats.mark('collide')
+
+            for i in refresh_client(self.data, self.store):
+                del self.entities[i]
+            self._grid = None
+            stats.mark('refresh')
+
+            presence.expire(self.backend, self.world, now, self.auth)
+            stats.mark('presence')
+            self.save()
+
+    def save(self):
+        """Saves the data of the client to the world.
+
+        If another request saved the world since it was loaded, the world is
+        loaded again and the data of the client is put into it, since nobody
+        else changes that data.
+        """
+        for i in xrange(self.SAVE_RETRIES):
+            self.world.clients[self.auth] = (self.data, self.store)
+            if self.backend.save_world(self.world):
+                return True
+            self.world = self.backend.load_world()
+
+        logging.warning('Gave up saving the world for client %s.' % self.auth)
+        return False
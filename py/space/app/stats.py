@@ -0,0 +1,149 @@
+# -*- coding: cp1252 -*-
+#
+# Copyright (c) 2008 Andreas Blixt <andreas@blixt.org>
+#
+# Project location:
+# /svn/trunk/py/space/ @ <http://code.google.com/p/blixt/>
+#
+# License: MIT license <http://www.opensource.org/licenses/mit-license.php>
+#
+
+"""Timing of the phases of requests to the Space server.
+
+A request is recorded between begin() and end(). Calls to mark() in between
+record the time since the previous mark as a phase of the request, and
+count() records values such as the number of entities sent. The results are
+gathered into histograms kept in the current process, which can be read at
+the /stats URL and are written to the log every LOG_INTERVAL seconds.
+
+Recording is turned on by setting ENABLED to True. When it's off, or outside
+a recorded request, mark() and count() return right away, so they can be
+called from anywhere.
+"""
+
+import bisect, logging, time
+
+ENABLED = False
+
+# The number of seconds between summaries written to the log.
+LOG_INTERVAL = 300
+
+class Histogram(object):
+    """Counts values in buckets whose bounds grow exponentially, which keeps
+    the relative error of percentiles the same for small and large values.
+    """
+
+    def __init__(self, start=0.01, factor=2.0, count=32):
+        self.bounds = [start * factor ** i for i in xrange(count)]
+        self.buckets = [0] * (count + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.buckets[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min: self.min = value
+        if self.max is None or value > self.max: self.max = value
+
+    def mean(self):
+        return self.count and self.total / self.count or 0.0
+
+    def percentile(self, p):
+        """Returns an upper bound of the value below which a fraction p of the
+        values are.
+        """
+        if not self.count:
+            return 0.0
+
+        target = p * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= target and n:
+                if i == len(self.bounds):
+                    return self.max
+                return min(self.bounds[i], self.max)
+        return self.max
+
+class Recording(object):
+    """The phases and counts of a single request."""
+
+    def __init__(self, name):
+        self.name = name
+        self.start = self.last = time.time()
+        self.phases = []
+        self.counts = []
+
+histograms = {}
+current = None
+last_log = time.time()
+
+def begin(name):
+    """Starts recording a request if instrumentation is turned on."""
+    global current
+    if ENABLED:
+        current = Recording(name)
+
+def mark(phase):
+    """Records the time since the previous mark as a phase of the current
+    request.
+    """
+    if current is None:
+        return
+
+    t = time.time()
+    current.phases.append((phase, t - current.last))
+    current.last = t
+
+def count(name, value):
+    """Records a value, such as a number of entities, for the current
+    request.
+    """
+    if current is not None:
+        current.counts.append((name, value))
+
+def end():
+    """Stops recording the current request and adds it to the histograms."""
+    global current, last_log
+    if current is None:
+        return
+
+    rec, current = current, None
+    t = time.time()
+    rec.phases.append(('total', t - rec.start))
+
+    # Times are kept in milliseconds and counts as they are.
+    for phase, seconds in rec.phases:
+        _histogram('%s.%s ms' % (rec.name, phase)).add(seconds * 1000)
+    for name, value in rec.counts:
+        _histogram('%s.%s' % (rec.name, name), 1.0).add(value)
+
+    if t - last_log >= LOG_INTERVAL:
+        last_log = t
+        logging.info('Request statistics:\n%s' % summary())
+
+def _histogram(key, start=0.01):
+    h = histograms.get(key)
+    if h is None:
+        h = histograms[key] = Histogram(start)
+    return h
+
+def summary():
+    """Returns the histograms as a table in plain text."""
+    lines = ['%-32s %8s %10s %10s %10s %10s' % ('', 'count', 'mean', 'p50',
+                                                'p99', 'max')]
+    keys = histograms.keys()
+    keys.sort()
+    for key in keys:
+        h = histograms[key]
+        lines.append('%-32s %8d %10.2f %10.2f %10.2f %10.2f' % (
+            key, h.count, h.mean(), h.percentile(0.5), h.percentile(0.99),
+            h.max))
+    return '\n'.join(lines)
+
+def reset():
+    """Forgets everything recorded so far."""
+    histograms.clear()
@@ -0,0 +1,185 @@
+# -*- coding: cp1252 -*-
+#
+# Copyright (c) 2008 Andreas Blixt <andreas@blixt.org>
+#
+# Project location:
+# /svn/trunk/py/space/ @ <http://code.google.com/p/blixt/>
+#
+# License: MIT license <http://www.opensource.org/licenses/mit-license.php>
+#
+
+"""Array-backed storage for the entities of the Space game.
+
+Instead of keeping one Python object per entity, the store keeps one array
+per attribute (positions, velocities, direction, type and time of last
+refresh) with the entities laid out side by side. This makes it cheap to
+pickle and lets all entities be moved in a single pass.
+
+Entities can have an expiry time, after which the store removes them in bulk.
+The ids of expired entities are kept in a free list so that they can be given
+to new entities instead of allocating new ids.
+"""
+
+from itertools import izip
+import array
+
+import space
+
+class EntityStore(object):
+    """A struct-of-arrays container of entities, keyed by entity id.
+
+    Entities are added from regular entity objects, after which they only
+    exist as a slot in the arrays of the store:
+    >>> store = EntityStore()
+    >>> store.add(projectile)
+    >>> store.refresh_all(space.now)
+    >>> store.expire(space.now)
+    """
+
+    # The arrays that hold one value per entity.
+    ARRAYS = ('ids', 'types', 'position_x', 'position_y', 'velocity_x',
+              'velocity_y', 'direction', 'last_refresh', 'expires')
+
+    def __init__(self):
+        self.ids = array.array('l')
+        self.types = array.array('b')
+        self.position_x = array.array('d')
+        self.position_y = array.array('d')
+        self.velocity_x = array.array('d')
+        self.velocity_y = array.array('d')
+        self.direction = array.array('d')
+        self.last_refresh = array.array('d')
+        self.expires = array.array('d')
+
+        self.free_ids = array.array('l')
+        self.slots = {}
+
+    def __contains__(self, ent_id):
+        return ent_id in self.slots
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getstate__(self):
+        # The slot lookup can be rebuilt from the ids, so leave it out of the
+        # pickled data.
+        state = self.__dict__.copy()
+        del state['slots']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+        # Stores pickled before entities could expire never expire them.
+        if 'expires' not in state:
+            self.expires = array.array('d', [0.0]) * len(self.ids)
+            self.free_ids = array.array('l')
+
+        self.slots = dict((ent_id, i) for i, ent_id in enumerate(self.ids))
+
+    def add(self, entity):
+        """Adds an entity to the store, copying its current state."""
+        if entity.id in self.slots:
+            self.remove(entity.id)
+
+        self.slots[entity.id] = len(self.ids)
+
+        self.ids.append(entity.id)
+        self.types.append(entity.TYPE)
+        self.position_x.append(entity.position_x)
+        self.position_y.append(entity.position_y)
+        self.velocity_x.append(entity.velocity_x)
+        self.velocity_y.append(entity.velocity_y)
+        self.direction.append(getattr(entity, 'direction', 0.0))
+        self.last_refresh.append(entity.last_refresh)
+        self.expires.append(getattr(entity, 'expires', 0.0))
+
+    def take_id(self):
+        """Returns an id that was freed by an expired entity, or None if
+        there is none.
+        """
+        if self.free_ids:
+            return self.free_ids.pop()
+        return None
+
+    def expire(self, now):
+        """Removes all entities whose expiry time is at or before `now`,
+        adding their ids to the free list. Entities with an expiry time of 0
+        never expire.
+
+        Returns the ids of the removed entities.
+        """
+        keep = [i for i, t in enumerate(self.expires) if not t or t > now]
+        if len(keep) == len(self.ids):
+            return []
+
+        keep_set = set(keep)
+        expired = [ent_id for i, ent_id in enumerate(self.ids)
+                   if i not in keep_set]
+
+        # Rebuilding the arrays once is cheaper than removing the entities one
+        # at a time, since many of them tend to expire together.
+        for name in self.ARRAYS:
+            a = getattr(self, name)
+            setattr(self, name, array.array(a.typecode, [a[i] for i in keep]))
+        self.slots = dict((ent_id, i) for i, ent_id in enumerate(self.ids))
+
+        self.free_ids.extend(expired)
+        return expired
+
+    def remove(self, ent_id, free=False):
+        """Removes an entity from the store. If free is True, the id of the
+        entity is added to the free list.
+
+        The last entity in the store is moved into the slot of the removed
+        entity so that the arrays never have any holes.
+        """
+        slot = self.slots.pop(ent_id)
+        last = len(self.ids) - 1
+
+        for name in self.ARRAYS:
+            a = getattr(self, name)
+            if slot != last: a[slot] = a[last]
+            a.pop()
+
+        if slot != last:
+            self.slots[self.ids[slot]] = slot
+
+        if free:
+            self.free_ids.append(ent_id)
+
+    def refresh_all(self, now):
+        """Moves all entities in the store to their positions at the time
+        `now`, wrapping them around the boundaries of the Universe.
+        """
+        count = len(self.ids)
+        if not count:
+            return
+
+        dims = space.DIMENSION_X, space.DIMENSION_Y
+        dts = [now - t for t in self.last_refresh]
+
+        # Using modulo for wrapping keeps entities inside the Universe no
+        # matter how many times they crossed its boundaries.
+        self.position_x = array.array('d', [
+            (x + v * dt) % dims[0]
+            for x, v, dt in izip(self.position_x, self.velocity_x, dts)])
+        self.position_y = array.array('d', [
+            (y + v * dt) % dims[1]
+            for y, v, dt in izip(self.position_y, self.velocity_y, dts)])
+
+        self.last_refresh = array.array('d', [now]) * count
+
+    def get_state(self, ent_id):
+        """Returns the state of an entity in the store as a tuple, in the same
+        format as Entity.get_state.
+        """
+        i = self.slots[ent_id]
+        return (self.types[i], self.position_x[i], self.position_y[i],
+                self.velocity_x[i], self.velocity_y[i], self.last_refresh[i])
+
+    def iterpositions(self):
+        """Yields an (id, position x, position y) tuple for every entity in
+        the store.
+        """
+        return izip(self.ids, self.position_x, self.position_y)
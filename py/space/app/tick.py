@@ -0,0 +1,279 @@
+# -*- coding: cp1252 -*-
+#
+# Copyright (c) 2008 Andreas Blixt <andreas@blixt.org>
+#
+# Project location:
+# /svn/trunk/py/space/ @ <http://code.google.com/p/blixt/>
+#
+# License: MIT license <http://www.opensource.org/licenses/mit-license.php>
+#
+
+"""Fixed-rate simulation of the Space world.
+
+Instead of every request advancing its own part of the world, the tick
+engine advances the whole world in ticks of a fixed length, applying the
+commands that clients queued since the last tick. After each run it
+publishes a snapshot of the world which request handlers can send to
+clients without touching the world themselves.
+
+Only one engine runs ticks at a time, guarded by a lease in the backend. The
+engine can be driven by a dedicated process calling run(), or by requesting
+the /tick URL regularly.
+"""
+
+import logging, time
+
+import collision, grid, presence, space, stats
+
+class _ClientContext(object):
+    """The parts of a session that entities use when handling commands."""
+
+    def __init__(self, auth, backend, data, store):
+        self.auth = auth
+        self.backend = backend
+        self.data = data
+        self.store = store
+        self.entities = {}
+        self.player = find_player(data)
+
+def find_player(data):
+    """Returns the player entity in the data of a client."""
+    for entity in data.itervalues():
+        if isinstance(entity, space.Player):
+            return entity
+    return None
+
+class PublishedWorld(object):
+    """The state of the world as published after a run of the tick engine.
+
+    The players dictionary maps auth keys to player ids and states is a list
+    of (id, state) pairs for all entities in the world. Hits is a list of the
+    projectiles that hit a player since the previous snapshot.
+    """
+
+    hits = ()
+
+    # A spatial grid of the states, so that finding the entities near each
+    # client doesn't have to go through every entity in the world. It is
+    # built when it's first needed and not pickled with the snapshot, which
+    # would make the snapshot twice as large.
+    grid = None
+
+    def __init__(self, version, time, players, states, hits=()):
+        self.version = version
+        self.time = time
+        self.players = players
+        self.states = states
+        self.hits = hits
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('grid', None)
+        return state
+
+    def visible_states(self, auth, radius=None, ghosts=()):
+        """Returns the (id, state) pairs to send to a client, limited to the
+        entities within radius of its player if a radius is given. Ghosts from
+        neighboring shards are added to the entities of the world.
+        """
+        if radius is None:
+            if ghosts:
+                return self.states + list(ghosts)
+            return self.states
+
+        if self.grid is None:
+            self.grid = grid.StateGrid(self.states)
+
+        state = self.grid.states.get(self.players[auth])
+        if state is None:
+            return []
+        return self.grid.within(state[1], state[2], radius, ghosts)
+
+class TickEngine(object):
+    """Advances the world at a fixed rate.
+
+    Usage:
+    >>> engine = TickEngine(rate=10)
+    >>> engine.queue(auth, space.ACCELERATE, packet_id)
+    >>> engine.run_due()
+    >>> engine.latest().states
+    """
+
+    LEASE = 'tick_lease'
+    LEASE_TIME = 5
+
+    # The most ticks to run at once. If the engine falls further behind, the
+    # extra ticks are skipped; entities still move the right distance since
+    # their motion does not depend on the ticks, but commands are applied
+    # later than they were sent.
+    MAX_TICKS = 50
+
+    SAVE_RETRIES = 5
+
+    def __init__(self, backend=None, rate=None, router=None, shard=0):
+        self.backend = backend or space.world_backend
+        self.rate = rate or space.TICK_RATE
+
+        # The engine of each shard only runs the world of that shard, handing
+        # off players that leave its region.
+        self.router = router
+        self.shard = shard
+
+    def queue(self, auth, command, packet_id, timestamp=None):
+        """Queues a command from a client, to be applied on the next tick.
+        The timestamp is the client time the command was sent at, if known.
+        """
+        self.backend.push('commands',
+                          (space.now, auth, command, packet_id, timestamp))
+
+    def latest(self):
+        """Returns the last published snapshot, or None if there is none."""
+        return self.backend.get('published')
+
+    def latest_version(self):
+        """Returns the world version of the last published snapshot, which is
+        much cheaper to check than getting the snapshot itself.
+        """
+        return self.backend.get('published_version') or 0
+
+    def run(self):
+        """Runs ticks at the tick rate forever. This is meant to be called
+        from a process dedicated to running the simulation.
+        """
+        dt = 1.0 / self.rate
+        while True:
+            start = time.time()
+            self.run_due(start)
+            time.sleep(max(0, dt - (time.time() - start)))
+
+    def run_due(self, now=None):
+        """Runs all ticks that are due and publishes the result.
+
+        Returns the number of ticks that were run, or None if another engine
+        is already running ticks.
+        """
+        if now is None:
+            now = time.time()
+
+        if not self.backend.acquire(self.LEASE, self.LEASE_TIME):
+            return None
+
+        try:
+            commands = self.backend.pop_all('commands')
+            stats.mark('commands')
+            stats.count('commands', len(commands))
+
+            for i in xrange(self.SAVE_RETRIES):
+                world = self.backend.load_world()
+                started = world.time is not None
+
+                ticks = self.advance(world, commands, now)
+                stats.mark('advance')
+                if started and not ticks and not commands:
+                    # Nothing changed, so don't wake up anybody waiting for
+                    # a new version.
+                    return 0
+
+                if self.router:
+                    self.router.rebalance(world, self.shard)
+
+                if self.backend.save_world(world): break
+            else:
+                # The commands are lost, but the next run will catch up.
+                logging.warning('Gave up saving the world after %d ticks.' %
+                                ticks)
+                return 0
+
+            # Commands that were only queued don't change what clients see.
+            if ticks or not started:
+                self.publish(world)
+                stats.mark('publish')
+            return ticks
+        finally:
+            self.backend.release(self.LEASE)
+
+    def advance(self, world, commands, now):
+        """Runs the ticks of the world that are due at the time now, applying
+        queued commands at the first tick after they arrived. Commands that
+        are not due yet are kept in the world.
+
+        Returns the number of ticks that were run.
+        """
+        dt = 1.0 / self.rate
+        if world.time is None:
+            world.time = now
+
+        pending = list(world.commands) + commands
+        pending.sort()
+
+        count = int((now - world.time) * self.rate)
+        if count > self.MAX_TICKS:
+            world.time += (count - self.MAX_TICKS) * dt
+            count = self.MAX_TICKS
+
+        saved_now = space.now
+        try:
+            for i in xrange(count):
+                space.now = world.time + dt
+
+                # Players are brought up to the time of the tick before their
+                # commands change how they move.
+                while pending and pending[0][0] <= space.now:
+                    # Commands queued before they had timestamps have four
+                    # items.
+                    item = pending.pop(0)
+                    auth, command, packet_id = item[1:4]
+                    timestamp = item[4:] and item[4] or None
+                    if not world.clients.get(auth): continue
+
+                    context = _ClientContext(auth, self.backend,
+                                             *world.clients[auth])
+                    if context.player:
+                        context.player.refresh()
+                        context.player.handle_command(context, command,
+                                                      packet_id, timestamp)
+
+                world.time = space.now
+
+            # Projectiles are swept along their whole path since the last run,
+            # so checking for hits once catches the same hits as checking on
+            # every tick.
+            space.now = world.time
+            world.hits = collision.collide(
+                [data for data in world.clients.itervalues() if data],
+                world.time)
+
+            # Motion is solved in closed form, so moving every entity once to
+            # the time of the last tick ends up the same as moving it on every
+            # tick.
+            for data in world.clients.itervalues():
+                if data: space.refresh_client(*data)
+
+            presence.expire(self.backend, world, world.time)
+        finally:
+            space.now = saved_now
+
+        world.commands = pending
+        return count
+
+    def publish(self, world):
+        """Publishes a snapshot of the world for request handlers to read."""
+        players = {}
+        states = []
+        for auth, data in world.clients.iteritems():
+            if not data: continue
+
+            entities, store = data
+            player = find_player(entities)
+            if player: players[auth] = player.id
+
+            for ent_id, entity in entities.iteritems():
+                states.append((ent_id, entity.get_state()))
+            for ent_id in store.ids:
+                states.append((ent_id, store.get_state(ent_id)))
+
+        self.backend.set('published', PublishedWorld(
+            world.version, world.time, players, states, world.hits))
+        if self.router:
+            self.router.publish_ghosts(self.shard, states)
+        self.backend.set('published_version', world.version)
@@ -0,0 +1,102 @@
+# -*- coding: cp1252 -*-
+#
+# Copyright (c) 2008 Andreas Blixt <andreas@blixt.org>
+#
+# Project location:
+# /svn/trunk/py/space/ @ <http://code.google.com/p/blixt/>
+#
+# License: MIT license <http://www.opensource.org/licenses/mit-license.php>
+#
+
+"""Benchmark of hit detection in the Space game.
+
+Times collision.detect for growing numbers of randomly placed entities, one in
+ten of them a player, and compares the hits against checking every projectile
+against every player for the smaller counts. Run it with the App Engine SDK
+on the Python path:
+
+    python bench_collision.py [seed]
+"""
+
+import math, os, random, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'app'))
+
+import collision, space
+
+COUNTS = (100, 1000, 10000, 100000)
+
+# The counts for which the result is checked against brute force.
+CHECK_LIMIT = 1000
+
+# The number of seconds since the last refresh of every entity.
+INTERVAL = 0.5
+
+def random_state(entity_type, speed, now):
+    direction = random.uniform(0, 6.2832)
+    velocity = random.uniform(0, speed)
+    return (entity_type,
+            random.uniform(0, space.DIMENSION_X),
+            random.uniform(0, space.DIMENSION_Y),
+            velocity * math.cos(direction),
+            velocity * math.sin(direction),
+            now - INTERVAL)
+
+def populate(count, now):
+    players = []
+    projectiles = []
+    for i in xrange(count):
+        if i % 10 == 0:
+            players.append((i, random_state(space.Player.TYPE,
+                                            space.Player.MAX_SPEED, now)))
+        else:
+            owner_id = players[-1][0]
+            projectiles.append((i, random_state(space.Projectile.TYPE,
+                                                space.Projectile.SPEED, now),
+                                owner_id, 0.0))
+    return players, projectiles
+
+def brute_force(players, projectiles, now):
+    hits = set()
+    radius = space.Player.RADIUS + space.Projectile.RADIUS
+    width, height = float(space.DIMENSION_X), float(space.DIMENSION_Y)
+    for proj_id, state, owner_id, expires in projectiles:
+        duration = now - state[5]
+        for player_id, p in players:
+            if player_id == owner_id: continue
+            lag = state[5] - p[5]
+            t = collision.sweep(
+                collision._wrap(state[1] - (p[1] + p[3] * lag), width),
+                collision._wrap(state[2] - (p[2] + p[4] * lag), height),
+                state[3] - p[3], state[4] - p[4], duration, radius)
+            if t is not None:
+                hits.add(proj_id)
+                break
+    return hits
+
+def main():
+    if len(sys.argv) > 1:
+        random.seed(int(sys.argv[1]))
+
+    now = time.time()
+    print '%8s %8s %8s %10s %12s' % ('entities', 'players', 'hits', 'seconds',
+                                     'us/entity')
+    for count in COUNTS:
+        players, projectiles = populate(count, now)
+
+        start = time.time()
+        hits = collision.detect(players, projectiles, now)
+        elapsed = time.time() - start
+
+        print '%8d %8d %8d %10.4f %12.2f' % (count, len(players), len(hits),
+                                             elapsed, elapsed / count * 1e6)
+
+        if count <= CHECK_LIMIT:
+            expected = brute_force(players, projectiles, now)
+            if expected != set(hit.projectile_id for hit in hits):
+                print 'Hits differ from brute force!'
+                sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+# -*- coding: cp1252 -*-
+#
+# Copyright (c) 2008 Andreas Blixt <andreas@blixt.org>
+#
+# Project location:
+# /svn/trunk/py/space/ @ <http://code.google.com/p/blixt/>
+#
+# License: MIT license <http://www.opensource.org/licenses/mit-license.php>
+#
+
+"""Property check of the equations of motion in the Space game.
+
+Advances random ship states with motion.advance and compares the result
+against stepping through time in small steps, the way Player.refresh used to.
+The states cover turning, thrusting, both at once, and entering and leaving
+the maximum speed. Run it with the App Engine SDK on the Python path:
+
+    python check_motion.py [seed] [cases]
+"""
+
+import math, os, random, sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'app'))
+
+import motion, space
+
+CASES = 300
+
+# The length of a step of the reference, in seconds.
+STEP = 0.001
+
+# The longest time a ship is advanced for, in seconds.
+MAX_DURATION = 20.0
+
+# How far apart the results may be. The step-wise reference is itself only
+# accurate to about a tenth of a unit over MAX_DURATION, and its velocity lags
+# by up to one step of acceleration.
+POSITION_TOLERANCE = 0.25
+VELOCITY_TOLERANCE = space.Player.ACCELERATION_RATE * STEP * 2
+DIRECTION_TOLERANCE = 1e-6
+
+KINDS = ('turn', 'thrust', 'turn and thrust', 'max speed')
+
+class Ship(object):
+    ACCELERATION_RATE = space.Player.ACCELERATION_RATE
+    TURN_RATE = space.Player.TURN_RATE
+    MAX_SPEED = space.Player.MAX_SPEED
+
+    def copy(self):
+        ship = Ship()
+        ship.__dict__.update(self.__dict__)
+        return ship
+
+def random_ship(kind):
+    ship = Ship()
+    ship.direction = random.uniform(0, math.pi * 2)
+    ship.position_x = ship.position_y = 0.0
+    ship.move_mod = random.choice((-1, 1))
+    ship.turn_mod = random.choice((-1, 1))
+
+    speed = random.uniform(0, Ship.MAX_SPEED)
+    heading = random.uniform(0, math.pi * 2)
+    if kind == 'turn':
+        ship.move_mod = 0
+    elif kind == 'thrust':
+        ship.turn_mod = 0
+    elif kind == 'max speed':
+        # Start at the maximum speed with the thrust keeping the ship there,
+        # and let it either keep going straight or turn away from it.
+        speed = Ship.MAX_SPEED
+        thrust = ship.direction + (math.pi if ship.move_mod < 0 else 0)
+        heading = thrust + random.uniform(-math.pi / 2, math.pi / 2)
+        ship.turn_mod = random.choice((-1, 0, 1))
+
+    ship.velocity_x = speed * math.cos(heading)
+    ship.velocity_y = speed * math.sin(heading)
+    return ship
+
+def stepwise(ship, dt):
+    """Advances a ship by dt seconds in steps of STEP seconds."""
+    steps = max(1, int(round(dt / STEP)))
+    step = dt / steps
+    for i in xrange(steps):
+        if ship.turn_mod:
+            ship.direction = (ship.direction + ship.TURN_RATE *
+                              ship.turn_mod * step) % (math.pi * 2)
+
+        if ship.move_mod:
+            m = ship.ACCELERATION_RATE * ship.move_mod * step
+            ship.velocity_x += math.cos(ship.direction) * m
+            ship.velocity_y += math.sin(ship.direction) * m
+
+            spd = math.hypot(ship.velocity_x, ship.velocity_y)
+            if spd > ship.MAX_SPEED:
+                ship.velocity_x *= ship.MAX_SPEED / spd
+                ship.velocity_y *= ship.MAX_SPEED / spd
+
+        ship.position_x += ship.velocity_x * step
+        ship.position_y += ship.velocity_y * step
+
+def compare(ship, dt):
+    """Returns the position, velocity and direction errors of motion.advance
+    for a ship advanced by dt seconds.
+    """
+    solved, expected = ship.copy(), ship.copy()
+    motion.advance(solved, dt)
+    stepwise(expected, dt)
+
+    direction = abs((solved.direction - expected.direction + math.pi) %
+                    (math.pi * 2) - math.pi)
+    return (math.hypot(solved.position_x - expected.position_x,
+                       solved.position_y - expected.position_y),
+            math.hypot(solved.velocity_x - expected.velocity_x,
+                       solved.velocity_y - expected.velocity_y),
+            direction)
+
+def main():
+    if len(sys.argv) > 1:
+        random.seed(int(sys.argv[1]))
+    cases = int(sys.argv[2]) if len(sys.argv) > 2 else CASES
+
+    worst = dict((kind, (0.0, 0.0, 0.0)) for kind in KINDS)
+    failed = 0
+    for i in xrange(cases):
+        kind = KINDS[i % len(KINDS)]
+        ship = random_ship(kind)
+        dt = random.uniform(0, MAX_DURATION)
+
+        errors = compare(ship, dt)
+        worst[kind] = tuple(map(max, worst[kind], errors))
+
+        if (errors[0] > POSITION_TOLERANCE or
+            errors[1] > VELOCITY_TOLERANCE or
+            errors[2] > DIRECTION_TOLERANCE):
+            failed += 1
+            print 'Mismatch (%s, %.3f s, move %d, turn %d): %r' % (
+                kind, dt, ship.move_mod, ship.turn_mod, errors)
+
+    print '%16s %10s %10s %10s' % ('kind', 'position', 'velocity',
+                                   'direction')
+    for kind in KINDS:
+        print '%16s %10.4f %10.4f %10.2g' % ((kind,) + worst[kind])
+
+    if failed:
+        print '%d of %d cases differ from the step-wise reference!' % (
+            failed, cases)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
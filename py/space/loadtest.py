@@ -0,0 +1,218 @@
+# -*- coding: cp1252 -*-
+#
+# Copyright (c) 2008 Andreas Blixt <andreas@blixt.org>
+#
+# Project location:
+# /svn/trunk/py/space/ @ <http://code.google.com/p/blixt/>
+#
+# License: MIT license <http://www.opensource.org/licenses/mit-license.php>
+#
+
+"""Headless load test of the Space server.
+
+Simulated clients send command streams like those of the browser client to
+the WSGI application in server.py. The application talks to the in-process
+memcache and datastore stubs of the App Engine SDK instead of the real
+services. For each number of players, the test reports the median and 99th
+percentile latency, the average size of a response and the number of requests
+handled per second.
+
+Run it with the App Engine SDK and its libraries on the Python path:
+
+    python loadtest.py [--players 1,10,100,1000] [--rounds 10] [--binary]
+                       [--tick RATE] [--seed N] [--stats]
+"""
+
+import optparse, os, random, re, sys, time, urllib
+import wsgiref.util
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'app'))
+
+from google.appengine.api import apiproxy_stub_map, datastore_file_stub
+from google.appengine.api import urlfetch_stub, user_service_stub
+from google.appengine.api.memcache import memcache_stub
+
+import protocol, server, space, stats, tick
+
+APP_ID = 'space'
+
+# How often simulated clients send each command. Most requests only poll for
+# the world, the same as an idle browser client.
+COMMANDS = [
+    (space.REFRESH, 60),
+    (space.ACCELERATE, 6),
+    (space.DECELERATE, 2),
+    (space.STOP, 4),
+    (space.TURN_LEFT, 6),
+    (space.TURN_RIGHT, 6),
+    (space.TURN_STOP, 8),
+    (space.SHOOT, 6),
+    (space.PING_REQUEST, 2)]
+
+def setup_stubs():
+    """Replaces the App Engine services with fresh in-process stubs."""
+    os.environ['APPLICATION_ID'] = APP_ID
+    os.environ['AUTH_DOMAIN'] = 'gmail.com'
+
+    stubs = apiproxy_stub_map.APIProxyStubMap()
+    stubs.RegisterStub('datastore_v3', datastore_file_stub.DatastoreFileStub(
+        APP_ID, None, None))
+    stubs.RegisterStub('memcache', memcache_stub.MemcacheServiceStub())
+    stubs.RegisterStub('urlfetch', urlfetch_stub.URLFetchServiceStub())
+    stubs.RegisterStub('user', user_service_stub.UserServiceStub())
+    apiproxy_stub_map.apiproxy = stubs
+
+def request(path, params):
+    """Sends a GET request to the application, returning the status line and
+    the body of the response.
+    """
+    environ = {'PATH_INFO': path, 'QUERY_STRING': urllib.urlencode(params),
+               'REQUEST_METHOD': 'GET'}
+    wsgiref.util.setup_testing_defaults(environ)
+
+    status = []
+    def start_response(status_line, headers, exc_info=None):
+        status.append(status_line)
+
+    body = ''.join(server.application(environ, start_response))
+    return status[0], body
+
+class SimulatedClient(object):
+    """A client sending commands the way the browser client does: every
+    request has the next packet id and acknowledges the last snapshot that
+    was applied, and a PONG follows every PING_REQUEST.
+    """
+
+    def __init__(self, rng, binary=False):
+        self.rng = rng
+        self.binary = binary
+
+        self.auth = ''
+        self.packet_id = 0
+        self.baseline = None
+        self.command = None
+
+        self.total = sum([weight for command, weight in COMMANDS])
+
+    def choose_command(self):
+        # The command sent when joining is ignored by the server.
+        if not self.auth:
+            return space.REFRESH
+        if self.command == space.PING_REQUEST:
+            return space.PONG
+
+        n = self.rng.randrange(self.total)
+        for command, weight in COMMANDS:
+            if n < weight: return command
+            n -= weight
+
+    def next_params(self):
+        """Returns the parameters of the next request of the client."""
+        self.packet_id += 1
+        self.command = self.choose_command()
+
+        params = {
+            space.AUTH_KEY: self.auth,
+            space.COMMAND: self.command,
+            space.PACKET_ID: self.packet_id,
+            space.TIMESTAMP: int(time.time() * 1000)}
+        if self.baseline is not None:
+            params[space.BASELINE] = self.baseline
+        if self.binary:
+            params[space.FORMAT] = space.VERSION
+        return params
+
+    def handle_response(self, body):
+        if not self.auth:
+            if self.binary:
+                self.auth = protocol.decode_binary(body)[space.AUTH_KEY]
+            else:
+                self.auth = re.search('"%s":"([^"]*)"' % space.AUTH_KEY,
+                                      body).group(1)
+
+        self.baseline = self.packet_id
+
+def percentile(values, p):
+    """Returns the value below which a fraction p of the sorted values are."""
+    return values[int(round(p * (len(values) - 1)))]
+
+def run(players, rounds, rng, binary=False, tick_rate=None):
+    """Joins a number of players and has each of them send a number of
+    requests, one round at a time.
+
+    Returns a (latencies, sizes, seconds) tuple for the requests after the
+    players joined.
+    """
+    setup_stubs()
+    space.TICK_RATE = tick_rate
+    stats.reset()
+
+    clients = [SimulatedClient(rng, binary) for i in xrange(players)]
+    for client in clients:
+        status, body = request('/server', client.next_params())
+        client.handle_response(body)
+
+    latencies = []
+    sizes = []
+    total = 0.0
+    for i in xrange(rounds):
+        if tick_rate:
+            tick.TickEngine().run_due()
+
+        for client in clients:
+            params = client.next_params()
+
+            start = time.time()
+            status, body = request('/server', params)
+            elapsed = time.time() - start
+
+            if not status.startswith('200'):
+                raise RuntimeError('Request failed: %s' % status)
+
+            client.handle_response(body)
+            latencies.append(elapsed)
+            sizes.append(len(body))
+            total += elapsed
+
+    latencies.sort()
+    return latencies, sizes, total
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--players', default='1,10,100,1000',
+                      help='comma separated numbers of players to test')
+    parser.add_option('--rounds', type='int', default=10,
+                      help='requests per player after joining')
+    parser.add_option('--binary', action='store_true', default=False,
+                      help='use the binary format instead of JSON')
+    parser.add_option('--tick', type='int', default=None,
+                      help='run the tick engine at this rate')
+    parser.add_option('--seed', type='int', default=None)
+    parser.add_option('--stats', action='store_true', default=False,
+                      help='show the time spent in each phase of requests')
+    options, args = parser.parse_args()
+
+    stats.ENABLED = options.stats
+
+    rng = random.Random(options.seed)
+
+    print '%8s %8s %9s %9s %10s %9s' % ('players', 'requests', 'p50 ms',
+                                        'p99 ms', 'bytes', 'req/s')
+    for players in [int(n) for n in options.players.split(',')]:
+        latencies, sizes, total = run(players, options.rounds, rng,
+                                      options.binary, options.tick)
+
+        print '%8d %8d %9.2f %9.2f %10.1f %9.1f' % (
+            players, len(latencies),
+            percentile(latencies, 0.5) * 1000,
+            percentile(latencies, 0.99) * 1000,
+            float(sum(sizes)) / len(sizes),
+            len(latencies) / total)
+        if options.stats:
+            print
+            print stats.summary()
+            print
+
+if __name__ == '__main__':
+    main()